@@ -1,16 +1,240 @@
 import asyncio
 import inspect
+import json
+import random
+import signal
+import sys
+import time
 import traceback
+import weakref
+from email.utils import parsedate_to_datetime
+
+# 可重试的 HTTP 状态码
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+def get_status_code(exc):
+    """
+    从不同 HTTP 库的异常中取出状态码：Kiota 的 APIError、aiohttp 的 ClientResponseError、httpx 的 HTTPStatusError
+    """
+    for attr in ("response_status_code", "status"):
+        status = getattr(exc, attr, None)
+        if isinstance(status, int):
+            return status
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+def get_retry_after(exc):
+    """
+    从异常携带的响应头中取出 Retry-After（秒），不存在或无法解析时返回 None
+    """
+    headers = getattr(exc, "response_headers", None) or getattr(exc, "headers", None) or getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = None
+    for key in headers.keys():
+        if str(key).lower() == "retry-after":
+            value = headers[key]
+            break
+    if value is None:
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _transient_exception_types():
+    # 只取已导入的 HTTP 库的异常类型，未导入的库不可能抛出异常，也避免为此导入耗时较长的库
+    types = [ConnectionError, TimeoutError, asyncio.TimeoutError]
+    httpx = sys.modules.get("httpx")
+    if httpx is not None:
+        types.append(httpx.TransportError)
+    aiohttp = sys.modules.get("aiohttp")
+    if aiohttp is not None:
+        types.extend([aiohttp.ClientConnectionError, aiohttp.ClientPayloadError])
+    return tuple(types)
+
+
+# 重试策略
+class RetryPolicy:
+    """
+    指数退避加随机抖动，服务端返回 Retry-After 时以其为准。
+    只对限流、服务端错误与网络错误重试，其它异常直接视为失败。
+    """
+    def __init__(self, max_attempts = 5, base_delay = 1.0, max_delay = 60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, exc):
+        status = get_status_code(exc)
+        if status is not None:
+            return status in RETRYABLE_STATUS_CODES
+        return isinstance(exc, _transient_exception_types())
+
+    def should_retry(self, exc, attempt):
+        return attempt < self.max_attempts and self.is_retryable(exc)
+
+    def delay(self, exc, attempt):
+        retry_after = get_retry_after(exc)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+
+async def call_with_retry(func, *args, retry_policy = None, timeout = None, **kwargs):
+    """
+    调用协程函数，按重试策略重试，timeout 为单次尝试的超时时间（秒）
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return await asyncio.wait_for(func(*args, **kwargs), timeout)
+        except Exception as e:
+            if interrupt_handler.interrupted or not retry_policy or not retry_policy.should_retry(e, attempt):
+                raise
+            await asyncio.sleep(retry_policy.delay(e, attempt))
+
+
+def write_dead_letter(path, task, error, attempts = None):
+    """
+    以 JSON 行向死信文件追加一个任务，task 需可被 json 序列化
+    """
+    record = {"task": task, "error": error, "attempts": attempts, "time": time.time()}
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def read_dead_letters(path):
+    """
+    读取死信文件，逐个返回其中记录的任务，可直接重新加入任务执行器
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)["task"]
+
+
+# 中断处理器
+class InterruptHandler:
+    """
+    第一次 SIGINT 取消所有已登记的执行器：停止接收新任务，正在执行的任务继续执行直到完成或超时；
+    第二次 SIGINT 强制中止正在执行的任务。执行器创建时自动登记，中断之后创建的执行器直接处于取消状态。
+    abort_only 为 True 的执行器第一次 SIGINT 时不取消，只在强制中止时取消。
+    """
+    def __init__(self):
+        self.count = 0
+        self.executors = weakref.WeakSet()
+        self.loop = None
+        self.installed = False
+
+    @property
+    def interrupted(self):
+        return self.count > 0
+
+    def register(self, executor):
+        self.executors.add(executor)
+        if self.count > 1 or (self.interrupted and not getattr(executor, "abort_only", False)):
+            executor.cancel()
+
+    def install(self):
+        self.loop = asyncio.get_running_loop()
+        try:
+            self.loop.add_signal_handler(signal.SIGINT, self.on_interrupt)
+        except NotImplementedError:
+            # Windows 下事件循环不支持 add_signal_handler
+            signal.signal(signal.SIGINT, lambda signum, frame: self.loop.call_soon_threadsafe(self.on_interrupt))
+        self.installed = True
+
+    def uninstall(self):
+        if not self.installed:
+            return
+        try:
+            self.loop.remove_signal_handler(signal.SIGINT)
+        except NotImplementedError:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+        self.installed = False
+
+    def on_interrupt(self):
+        self.count += 1
+        if self.count == 1:
+            # 输出到 stderr，不混入 jsonl 进度输出
+            print("\n收到中断信号，停止接收新任务，等待执行中的任务完成，再次按 Ctrl-C 强制中止 ...", file=sys.stderr)
+            for executor in list(self.executors):
+                if not getattr(executor, "abort_only", False):
+                    executor.cancel()
+        else:
+            print("\n强制中止执行中的任务 ...", file=sys.stderr)
+            for executor in list(self.executors):
+                executor.abort()
+
+interrupt_handler = InterruptHandler()
+
+
+# 全局并发预算
+class ConcurrencyBudget:
+    """
+    同一进程内所有执行器共享的并发上限，用于多个任务同时运行时限制总请求数。
+    未设置上限时不做限制，上限应在创建任何执行器之前设置。
+    """
+    def __init__(self):
+        self.semaphore = None
+
+    def set_limit(self, limit):
+        self.semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def __aenter__(self):
+        if self.semaphore:
+            await self.semaphore.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.semaphore:
+            self.semaphore.release()
+
+concurrency_budget = ConcurrencyBudget()
+
 
 # 协程任务执行器
 class AsyncTaskExecutor:
-    def __init__(self, concurrency, task_func = lambda x: x):
+    """
+    retry_policy 为 None 时不重试，task_timeout 为单个任务单次尝试的超时时间（秒），超时按网络错误重试。任务最终失败时：
+    设置了 dead_letter_path 则以 JSON 行追加到该文件，task_encoder 用于将任务转换为可序列化的对象；
+    设置了 on_dead_letter(task, exc) 则调用该回调；两者都未设置时打印错误与调用栈。
+    执行器被取消后，尚未开始的任务与之后添加的任务不再执行，设置了 dead_letter_path 时同样写入死信文件以便重新执行。
+    任务执行时同时占用全局并发预算，use_budget 为 False 时不占用，适用于长时间等待而不发请求的任务。
+    abort_only 为 True 时第一次中断不取消执行器，任务继续执行到完成，适用于跟踪服务端已接受的操作，只有强制中止时才取消。
+    """
+    def __init__(self, concurrency, task_func = lambda x: x, retry_policy = None, dead_letter_path = None, task_encoder = lambda x: x, on_dead_letter = None, task_timeout = None, use_budget = True, abort_only = False):
         self.tasks = asyncio.Queue(maxsize=concurrency * 10)
         self.semaphore = asyncio.Semaphore(concurrency)
         self.task_func = task_func
+        self.retry_policy = retry_policy
+        self.dead_letter_path = dead_letter_path
+        self.task_encoder = task_encoder
+        self.on_dead_letter = on_dead_letter
+        self.task_timeout = task_timeout
+        self.use_budget = use_budget
+        self.abort_only = abort_only
+        self.dead_letter_count = 0
+        self.cancelled_count = 0
+        self.cancelled = False
+        self.in_flight = dict()
         self.stop_sentinel = object()
         self.stopped = False
         self.workers = [asyncio.create_task(self.worker(i + 1)) for i in range(concurrency)]
+        interrupt_handler.register(self)
+
+    async def run_task(self, task):
+        if inspect.iscoroutinefunction(self.task_func):
+            await asyncio.wait_for(self.task_func(task), self.task_timeout)
+        else:
+            self.task_func(task)
 
     async def worker(self, wid):
         while True:
@@ -18,29 +242,106 @@ class AsyncTaskExecutor:
             if task is self.stop_sentinel:
                 self.tasks.task_done()
                 break
-            async with self.semaphore:
-                try:
-                    if inspect.iscoroutinefunction(self.task_func):
-                        await self.task_func(task)
-                    else:
-                        self.task_func(task)
-                except Exception as e:
-                    print(f"工作协程 {wid} 发生错误: {e}")
-                    traceback.print_exc()
-                finally:
-                    self.tasks.task_done()
+            if self.cancelled:
+                self.record_cancelled(task)
+                self.tasks.task_done()
+                continue
+            self.in_flight[wid] = task
+            try:
+                attempt = 0
+                while True:
+                    attempt += 1
+                    try:
+                        async with self.semaphore:
+                            if self.use_budget:
+                                async with concurrency_budget:
+                                    await self.run_task(task)
+                            else:
+                                await self.run_task(task)
+                        break
+                    except Exception as e:
+                        # 退避期间不占用并发名额，取消后不再重试
+                        if not self.cancelled and self.retry_policy and self.retry_policy.should_retry(e, attempt):
+                            await asyncio.sleep(self.retry_policy.delay(e, attempt))
+                            continue
+                        self.dead_letter(wid, task, e, attempt)
+                        break
+            finally:
+                self.in_flight.pop(wid, None)
+                self.tasks.task_done()
+
+    def write_dead_letter(self, task, error, attempts):
+        if self.dead_letter_path:
+            write_dead_letter(self.dead_letter_path, self.task_encoder(task), error, attempts)
+
+    def record_cancelled(self, task):
+        self.cancelled_count += 1
+        self.write_dead_letter(task, "cancelled", 0)
+
+    def dead_letter(self, wid, task, exc, attempts):
+        self.dead_letter_count += 1
+        self.write_dead_letter(task, f"{type(exc).__name__}: {exc}", attempts)
+        if self.on_dead_letter:
+            # 回调出错不能使工作协程退出，否则队列中剩余的任务无人处理，add_tasks 与 shutdown 会一直等待
+            try:
+                self.on_dead_letter(task, exc)
+            except Exception as e:
+                print(f"工作协程 {wid} 处理失败任务时发生错误: {e}", file=sys.stderr)
+                traceback.print_exception(e)
+        if not self.dead_letter_path and not self.on_dead_letter:
+            print(f"工作协程 {wid} 发生错误: {exc}")
+            traceback.print_exception(exc)
 
     async def add_task(self, task):
         if self.stopped:
             raise RuntimeError("任务执行器已停止，无法添加新任务")
+        if self.cancelled:
+            self.record_cancelled(task)
+            return
         await self.tasks.put(task)
 
     async def add_tasks(self, tasks):
         if self.stopped:
             raise RuntimeError("任务执行器已停止，无法添加新任务")
         for task in tasks:
+            if self.cancelled:
+                self.record_cancelled(task)
+                continue
             await self.tasks.put(task)
 
+    def cancel(self):
+        """
+        停止接收新任务，丢弃队列中尚未开始的任务，正在执行的任务继续执行
+        """
+        if self.cancelled:
+            return
+        self.cancelled = True
+        sentinel_count = 0
+        while True:
+            try:
+                task = self.tasks.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if task is self.stop_sentinel:
+                sentinel_count += 1
+            else:
+                self.record_cancelled(task)
+            self.tasks.task_done()
+        # 关闭时放入的结束标记也被取出了，重新放回
+        for _ in range(sentinel_count):
+            self.tasks.put_nowait(self.stop_sentinel)
+
+    def abort(self):
+        """
+        取消执行器并强制中止正在执行的任务，被中止的任务同样记为已取消
+        """
+        self.cancel()
+        for task in list(self.in_flight.values()):
+            self.record_cancelled(task)
+        self.in_flight.clear()
+        for worker in self.workers:
+            worker.cancel()
+
     async def join(self):
         await self.tasks.join()
 
@@ -0,0 +1,235 @@
+# 批量执行任务：在同一进程内并发运行配置文件中的多个复制、历史版本移除与权限管理任务，
+# 所有任务共享同一个认证凭据、同一个 Graph 客户端（及其连接池）与同一个全局并发预算，全程无需交互
+#
+# 用法: python batchRunner.py jobs.json
+# 配置文件格式参见 jobs.example.json
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import sys
+from typing import TYPE_CHECKING
+import copy_files
+import onedrive_permission_manager
+import remove_history_version
+from asyncTaskExecutor import concurrency_budget, interrupt_handler
+from driveWalker import get_drive_item_by_path
+from executionPlan import RUN_MODES
+from httpTransport import shared_transport
+from progressReporter import print_message
+
+# msgraph 与 azure.identity 导入耗时较长，校验配置之后才导入
+if TYPE_CHECKING:
+    from msgraph.graph_service_client import GraphServiceClient
+
+# --- 默认配置，可在配置文件中覆盖 ---
+# 所有任务合计同时进行的最大请求数
+CONCURRENCY = 20
+# 进度输出方式，多个任务同时运行时只能使用 jsonl
+PROGRESS_MODE = "jsonl"
+
+JOB_TYPES = ("copy", "remove_history_version", "permission")
+# 复制任务可用的冲突处理方式，rename 会在重试或重新执行时产生重复的副本，批量执行时不允许
+CONFLICT_BEHAVIORS = ("fail", "replace")
+
+
+def load_config(path: str):
+    """
+    读取并校验配置文件，为每个任务补全名称、执行模式、死信文件与计划文件路径
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    if not config.get("client_id"):
+        raise ValueError("配置文件缺少 client_id")
+    jobs = config.get("jobs") or []
+    if not jobs:
+        raise ValueError("配置文件中没有任务")
+    names = set()
+    for i, job in enumerate(jobs):
+        if job.get("type") not in JOB_TYPES:
+            raise ValueError(f"第 {i + 1} 个任务的类型 {job.get('type')} 无效，可选 {', '.join(JOB_TYPES)}")
+        job.setdefault("name", f"{job['type']}-{i + 1}")
+        if job["name"] in names:
+            raise ValueError(f"任务名称 {job['name']} 重复")
+        names.add(job["name"])
+        job.setdefault("dead_letter_path", f"{job['name']}_failed.jsonl")
+        job.setdefault("mode", "run")
+        if job["mode"] not in RUN_MODES:
+            raise ValueError(f"任务 {job['name']} 的执行模式 {job['mode']} 无效，可选 {', '.join(RUN_MODES)}")
+        job.setdefault("plan_path", f"{job['name']}_plan.jsonl")
+        if job["type"] == "copy" and job.get("conflict_behavior") not in (None, *CONFLICT_BEHAVIORS):
+            raise ValueError(f"任务 {job['name']} 的冲突处理方式 {job['conflict_behavior']} 无效，可选 {', '.join(CONFLICT_BEHAVIORS)}")
+        # 只生成计划时不发出移除请求，无需请求头
+        if job["type"] == "remove_history_version" and (job["mode"] != "plan" or job.get("replay_dead_letter")):
+            if not isinstance(job.get("headers"), dict) or not (job.get("request_digest") or job["headers"].get("x-requestdigest")):
+                raise ValueError(f"任务 {job['name']} 缺少从浏览器复制的 headers 或其中的 x-requestdigest（也可用 request_digest 单独指定）")
+    return config
+
+
+async def find_source_root(client: GraphServiceClient, drive_id: str, shared_item_name: str = None):
+    """
+    获取复制任务源路径的起点：未指定共享项时为用户的 OneDrive 根目录，否则为名称匹配的共享项
+    """
+    if not shared_item_name:
+        return await client.drives.by_drive_id(drive_id).root.get()
+    for item in await copy_files.list_shared_items(client, drive_id):
+        if item.remote_item and item.remote_item.name == shared_item_name:
+            return item.remote_item
+    raise ValueError(f"未找到共享给我的项 {shared_item_name}")
+
+
+async def run_copy_job(client: GraphServiceClient, drive_id: str, job: dict):
+    if job.get("replay_dead_letter"):
+        await copy_files.replay_dead_letters(client, job["replay_dead_letter"], job.get("conflict_behavior"), job["dead_letter_path"], job["name"])
+        return
+    if job["mode"] == "apply":
+        await copy_files.apply_plan(client, job["plan_path"], job.get("conflict_behavior"), job["dead_letter_path"], job["name"], job.get("verify"))
+        return
+    source_root = await find_source_root(client, drive_id, job.get("shared_item"))
+    source_item = await get_drive_item_by_path(client, source_root.parent_reference.drive_id, job.get("source_path", "/"), root_id=source_root.id)
+    if source_item is None or not source_item.id:
+        raise ValueError(f"未找到源路径 {job.get('source_path', '/')}")
+    target_parent_item = await get_drive_item_by_path(client, drive_id, job.get("target_path", "/"), auto_create=True)
+    if target_parent_item is None or not target_parent_item.id:
+        raise ValueError(f"未找到或创建目标路径 {job.get('target_path', '/')}")
+    plan_path = job["plan_path"] if job["mode"] == "plan" else None
+    await copy_files.copy_files(client, source_item, target_parent_item, job.get("conflict_behavior"), job["dead_letter_path"], job["name"], plan_path, job.get("verify"))
+
+
+async def run_remove_history_version_job(client: GraphServiceClient, drive_id: str, job: dict):
+    # 每个任务使用配置文件中的请求头，令牌过期时不提示输入，剩余文件写入死信文件后任务失败
+    job_headers = dict(job.get("headers") or {})
+    if job.get("request_digest"):
+        job_headers["x-requestdigest"] = job["request_digest"]
+    session = remove_history_version.SharePointSession(job_headers, interactive=False)
+    await _run_remove_history_version_job(client, drive_id, job, session)
+    if session.expired:
+        raise RuntimeError(f"请求令牌已过期，请更新 headers 后通过 replay_dead_letter 重新处理 {job['dead_letter_path']}")
+
+
+async def _run_remove_history_version_job(client: GraphServiceClient, drive_id: str, job: dict, session):
+    if job.get("replay_dead_letter"):
+        await remove_history_version.replay_dead_letters(client, job["replay_dead_letter"], job["dead_letter_path"], job["name"], session)
+        return
+    if job["mode"] == "apply":
+        await remove_history_version.apply_plan(client, job["plan_path"], job["dead_letter_path"], job["name"], session)
+        return
+    item = await get_drive_item_by_path(client, drive_id, job.get("path", "/"))
+    if not item or not item.id:
+        raise ValueError(f"未找到路径 {job.get('path', '/')}")
+    plan_path = job["plan_path"] if job["mode"] == "plan" else None
+    await remove_history_version.traverse_and_remove_versions(client, item, job["dead_letter_path"], job["name"], plan_path, session)
+
+
+async def run_permission_job(client: GraphServiceClient, drive_id: str, job: dict):
+    if job["mode"] == "apply":
+        await onedrive_permission_manager.apply_plan(client, job["plan_path"], job["name"])
+        return
+    folder = await get_drive_item_by_path(client, drive_id, job.get("path", "/"))
+    if not folder or not folder.id:
+        raise ValueError(f"未找到路径 {job.get('path', '/')}")
+    onedrive_permission_manager.id2Name[folder.id] = folder.name
+    await onedrive_permission_manager.manage_permissions(
+        client,
+        drive_id,
+        folder.id,
+        recursive=job.get("recursive", False),
+        recipient_email=job.get("recipient_email"),
+        share_permission=job.get("share_permission"),
+        plan_path=job["plan_path"] if job["mode"] == "plan" else None,
+        name=job["name"],
+    )
+
+
+JOB_RUNNERS = {
+    "copy": run_copy_job,
+    "remove_history_version": run_remove_history_version_job,
+    "permission": run_permission_job,
+}
+
+
+def prompt_device_code(verification_uri, user_code, expires_on):
+    """
+    设备代码认证提示输出到标准错误，标准输出只保留任务的 jsonl 事件
+    """
+    print(f"请在浏览器中打开 {verification_uri} 并输入代码 {user_code} 完成认证。", file=sys.stderr)
+
+
+async def run_jobs(config: dict):
+    """
+    并发运行所有任务，返回 {任务名称: 异常或 None}
+    """
+    from fileBackedDeviceCodeCredential import FileBackedDeviceCodeCredential
+
+    scopes = ["https://graph.microsoft.com/.default"]
+    credential = FileBackedDeviceCodeCredential(client_id=config["client_id"], file_path=config.get("credential_file"), prompt_callback=prompt_device_code)
+    # 所有任务的 Graph 请求与 SharePoint REST 请求共用同一个连接池，连接数随全局并发预算设置
+    shared_transport.configure(config.get("concurrency", CONCURRENCY))
+    client = shared_transport.create_graph_client(credential, scopes)
+    drive = await client.me.drive.get()
+    if not drive or not drive.id:
+        raise RuntimeError("无法获取用户的 Drive 信息。请确保账户有 OneDrive for Business。")
+
+    jobs = config["jobs"]
+    concurrency_budget.set_limit(config.get("concurrency", CONCURRENCY))
+    progress_mode = config.get("progress_mode", PROGRESS_MODE)
+    if progress_mode == "live" and len(jobs) > 1:
+        print("多个任务同时运行时无法使用 live 进度输出，已改为 jsonl。", file=sys.stderr)
+        progress_mode = "jsonl"
+    copy_files.PROGRESS_MODE = progress_mode
+    remove_history_version.PROGRESS_MODE = progress_mode
+    onedrive_permission_manager.PROGRESS_MODE = progress_mode
+    config["progress_mode"] = progress_mode
+
+    interrupt_handler.install()
+    try:
+        results = await asyncio.gather(*[JOB_RUNNERS[job["type"]](client, drive.id, job) for job in jobs], return_exceptions=True)
+    finally:
+        interrupt_handler.uninstall()
+    return {job["name"]: (result if isinstance(result, BaseException) else None) for job, result in zip(jobs, results)}
+
+
+async def main():
+    """
+    主函数
+    """
+    parser = argparse.ArgumentParser(description="在同一进程内并发执行多个 OneDrive 任务")
+    parser.add_argument("config", help="任务配置文件路径（JSON）")
+    args = parser.parse_args()
+
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError) as e:
+        print(f"读取配置文件失败: {e}", file=sys.stderr)
+        return 2
+
+    try:
+        results = await run_jobs(config)
+    except Exception as e:
+        print(f"发生错误: {e}", file=sys.stderr)
+        if "AADSTS700016" in str(e):
+            print("认证错误: 应用标识符(CLIENT_ID)可能不正确或未在目标租户中正确配置。", file=sys.stderr)
+        elif "AADSTS900561" in str(e):
+            print("认证错误: 设备代码认证流程未完成或已超时。", file=sys.stderr)
+        return 1
+
+    # jsonl 模式下结果同样按行输出 JSON，保证输出流可以逐行解析
+    progress_mode = config.get("progress_mode", PROGRESS_MODE)
+    failed = 0
+    for name, error in results.items():
+        if error is None:
+            print_message(f"任务 {name} 完成。", progress_mode, name)
+        else:
+            failed += 1
+            print_message(f"任务 {name} 失败: {error}", progress_mode, name)
+    if interrupt_handler.interrupted:
+        print_message("任务已中断，未完成的部分已写入各任务的死信文件，可通过 replay_dead_letter 重新执行。", progress_mode)
+    return 1 if failed or interrupt_handler.interrupted else 0
+
+
+if __name__ == "__main__":
+    # 首次运行时需要进行设备代码认证
+    print("该脚本需要您进行认证。", file=sys.stderr)
+    sys.exit(asyncio.run(main()))
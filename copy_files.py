@@ -4,16 +4,26 @@
 # 1. Files.ReadWrite.All: 允许应用读取、创建、修改和删除所有用户的 OneDrive 文件。这是分享和遍历文件夹所必需的。
 # 2. User.Read: 允许应用读取登录用户的基本个人资料。
 
+from __future__ import annotations
+
 import asyncio
-from rich.console import Console
-from rich.live import Live
-from asyncTaskExecutor import AsyncTaskExecutor
-from fileBackedDeviceCodeCredential import FileBackedDeviceCodeCredential
-from msgraph.graph_service_client import GraphServiceClient
-from msgraph.generated.models.drive_item import DriveItem
-from msgraph.generated.models.folder import Folder
-from msgraph.generated.models.item_reference import ItemReference
-from msgraph.generated.drives.item.items.item.copy.copy_post_request_body import CopyPostRequestBody
+import json
+from typing import TYPE_CHECKING
+from asyncTaskExecutor import AsyncTaskExecutor, RetryPolicy, call_with_retry, get_status_code, read_dead_letters, write_dead_letter, interrupt_handler
+from driveItemRecord import ItemRecord, SpillList
+from progressReporter import ProgressReporter, escape_markup, print_message
+from driveQuery import VERIFY_SELECT
+from driveWalker import get_drive_item_by_path, list_children, walk
+from executionPlan import PlanWriter, RUN_MODES, read_plan_actions, read_plan_header
+from httpTransport import raise_for_status, shared_transport
+from streamCopy import stream_copy_file
+
+# msgraph、azure.identity 与 httpx 导入耗时较长，只在用到时导入，脚本启动与被其它脚本导入时无需等待
+if TYPE_CHECKING:
+    import httpx
+    from msgraph.graph_service_client import GraphServiceClient
+    from msgraph.generated.models.drive_item import DriveItem
+    from msgraph.generated.drives.item.items.item.copy.copy_post_request_body import CopyPostRequestBody
 
 # --- 配置信息 ---
 # 在 Azure AD 中注册应用后获取，形如aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee
@@ -24,192 +34,804 @@ SOURCE_PATH = "/"
 TARGET_PARENT_PATH = "/"
 # 冲突时的处理方式，可选 fail 、 replace ，不支持rename
 CONFLICT_BEHAVIOR = "fail"
+# 目标中不存在对应文件夹时，是否对整个文件夹发起一次服务端复制，而不是创建文件夹后逐个复制文件
+WHOLE_FOLDER_COPY = True
+# 轮询文件夹复制进度的间隔（秒）
+COPY_MONITOR_INTERVAL = 5
+# 服务端复制失败（跨租户、部分共享项等不支持复制的源）时，是否改为从源下载并流式上传到目标，文件夹则在目标中创建后逐个复制其子项
+STREAM_COPY_FALLBACK = True
+# 服务端复制返回这些状态码或监视地址报告失败时按 STREAM_COPY_FALLBACK 处理，其余错误按重试策略处理
+STREAM_FALLBACK_STATUS_CODES = (400, 403, 501)
+# 同时流式复制的文件数，每个文件的内存占用见 streamCopy 中的 CHUNK_SIZE 与 PREFETCH_CHUNKS
+STREAM_CONCURRENCY = 2
 # 用户认证信息缓存路径，用于一段时间内免重复认证
 CREDENTIAL_FILE_PATH = "userXXX.json"
 # 同时处理的任务数
 CONCURRENCY = 10
+# 待复制列表在内存中保留的最大条目数，超出部分溢出到临时文件，为 None 时不溢出
+SPILL_THRESHOLD = 100000
+# 单个任务的最大尝试次数，遇到限流、服务端错误或网络错误时按指数退避重试
+MAX_ATTEMPTS = 5
+# 单个任务单次尝试的超时时间（秒），超时后按重试策略重试，为 None 时不限制
+TASK_TIMEOUT = 300
+# 重试后仍失败的复制任务会以 JSON 行追加到此文件
+DEAD_LETTER_PATH = "copy_files_failed.jsonl"
+# 设置为死信文件路径时，跳过交互直接重新执行其中的复制任务
+REPLAY_DEAD_LETTER_PATH = None
+# 复制完成后是否并发遍历源与目标，按相对路径比较文件大小与 quickXorHash
+VERIFY_AFTER_COPY = False
+# 校验发现的不一致与缺失项以 JSON 行写入此文件
+VERIFY_REPORT_PATH = "copy_files_verify.jsonl"
+# 校验后是否以 replace 重新复制不一致与缺失的项
+VERIFY_REQUEUE = False
+# 校验时仍在服务端复制中的文件，每隔 COPY_MONITOR_INTERVAL 秒重新列举其目标父文件夹再比较，最多重新列举的次数
+VERIFY_RECHECK_PASSES = 3
+# 执行模式，run 为遍历后直接复制，plan 为只遍历并将待复制的项与待创建的文件夹写入 PLAN_PATH，apply 为跳过交互直接执行 PLAN_PATH 中的计划
+RUN_MODE = "run"
+# 执行计划文件路径
+PLAN_PATH = "copy_files_plan.jsonl"
+# 进度输出方式，live 为终端实时刷新，jsonl 为每隔一段时间输出一行 JSON（适合定时任务或 CI）
+PROGRESS_MODE = "live"
+# 进度刷新间隔（秒），为 None 时 live 模式 0.25 秒，jsonl 模式 5 秒
+PROGRESS_INTERVAL = None
+
+# 计划中待创建的目标文件夹以此为前缀的占位 id 表示，执行计划时替换为实际创建的文件夹 id
+PLANNED_FOLDER_PREFIX = "planned:"
 
 id2Name = dict()
 
-async def copy_files(client: GraphServiceClient, source_item: DriveItem, target_parent_item: DriveItem):
+def create_progress(name: str = None, planning: bool = False):
+    """
+    创建复制任务的进度器，统计 总数，复制中，已复制，已跳过，失败的数量，planning 为 True 时以 已计划 代替 已复制
+    """
+    return ProgressReporter(
+        [("total", "总数", "bold blue"), ("copying", "复制中", "bold yellow"), ("copied", "已计划" if planning else "已复制", "bold green"), ("skipped", "已跳过", "bold cyan"), ("failed", "失败", "bold red")],
+        total_key="total",
+        done_keys=("copying", "copied", "skipped", "failed"),
+        mode=PROGRESS_MODE,
+        interval=PROGRESS_INTERVAL,
+        name=name,
+    )
+
+async def create_target_folder(client: GraphServiceClient, drive_id: str, parent_id: str, name: str):
     """
-    复制文件或文件夹
+    在目标父文件夹下创建文件夹，返回新文件夹的 id
+    """
+    from msgraph.generated.models.drive_item import DriveItem
+    from msgraph.generated.models.folder import Folder
+    target_item = await client.drives.by_drive_id(drive_id).items.by_drive_item_id(parent_id).children.post(DriveItem(name=name, folder=Folder()))
+    id2Name[f'{drive_id}:{target_item.id}'] = name
+    return target_item.id
+
+async def copy_files(client: GraphServiceClient, source_item: DriveItem, target_parent_item: DriveItem, conflict_behavior: str = None, dead_letter_path: str = None, name: str = None, plan_path: str = None, verify: bool = None):
+    """
+    复制文件或文件夹，conflict_behavior 与 dead_letter_path 为 None 时使用对应的配置项，name 用于区分同时运行的多个任务的输出。
+    plan_path 不为 None 时只遍历，不创建文件夹也不复制，待创建的文件夹与待复制的项写入该计划文件，由 apply_plan 执行。
+    verify 为 None 时使用 VERIFY_AFTER_COPY，为 True 时复制完成后校验目标与源是否一致。
     """
     if not source_item or not source_item.id or not target_parent_item or not target_parent_item.id:
-        print("源项或目标项无效，无法复制。")
+        print_message("源项或目标项无效，无法复制。", PROGRESS_MODE, name)
         return
 
     source_drive_id = getattr((source_item.remote_item if source_item.remote_item else source_item).parent_reference, "drive_id")
     target_drive_id = getattr(target_parent_item.parent_reference, "drive_id")
 
-    total_count = 0
-    copying_count = 0
-    copied_count = 0
-    failed_count = 0
-
-    # 使用 rich 库打印 总数，已复制，失败的数量
-    live = Live(console=Console())
-    def print_status():
-        live.update(f"[bold blue]总数: {total_count}[/] [bold yellow]复制中: {copying_count}[/] [bold green]已复制: {copied_count}[/] [bold red]失败: {failed_count}[/]")
-
-    # 先遍历源项及其子项，在目标项下创建对应的文件夹
-    # 遍历源项 协程任务执行器
-    traverse_executor = AsyncTaskExecutor(CONCURRENCY)
-    waiting_copy = []
-    target_children_cache = dict()  # 缓存目标文件夹的子项，避免重复请求
-    async def traverse_task_func(task):
-        nonlocal total_count
-        item, target_parent_item = task
-        target_parent_children = target_children_cache.get(target_parent_item.id, None)
+    conflict_behavior = conflict_behavior or CONFLICT_BEHAVIOR
+    dead_letter_path = dead_letter_path or DEAD_LETTER_PATH
+    # 冲突时失败的情况下，目标中已存在的同名文件必然复制失败，遍历时直接跳过，不再发起请求
+    skip_existing = conflict_behavior == "fail"
+    progress = create_progress(name, planning=plan_path is not None)
+    plan = None
+    if plan_path is not None:
+        plan = PlanWriter(
+            plan_path,
+            "copy_files",
+            source_drive_id=source_drive_id,
+            target_drive_id=target_drive_id,
+            conflict_behavior=conflict_behavior,
+            source=ItemRecord.from_drive_item(source_item),
+            target_parent_id=target_parent_item.id,
+        )
+
+    # 按层规划：每一层先并发列举已存在的目标父文件夹，再逐个决定源文件夹的处理方式
+    #   目标中已存在同名文件夹 -> 继续列举源文件夹的子项，在其中合并
+    #   目标中不存在且开启 WHOLE_FOLDER_COPY -> 整个文件夹一次服务端复制，不再列举其子项
+    #   目标中不存在且关闭 WHOLE_FOLDER_COPY -> 创建目标文件夹，其子项逐个复制
+    # skip_existing 时还会列举每个已存在的目标文件夹，其中的同名文件与同名的文件夹不再复制
+    # 待复制列表中只保存精简记录 (源项记录, 源父文件夹 id)，源项本身的父文件夹 id 为 None
+    waiting_copy = SpillList(SPILL_THRESHOLD, decode=lambda row: (ItemRecord(*row[0]), row[1]))
+    # 源文件夹 id -> 目标文件夹 id，None 对应目标父项
+    target_map = {None: target_parent_item.id}
+    # 本次运行创建的目标文件夹必然为空，无需再列举其子项
+    created_ids = set()
+    target_children_cache = dict()  # 缓存目标文件夹下的子文件夹 名称（不区分大小写） -> id，避免重复请求
+    target_files_cache = dict()  # skip_existing 时缓存目标文件夹下的文件 名称（不区分大小写） -> 大小
+    next_level = []
+    depth = 0
+
+    async def list_target_task_func(target_id):
+        target_children = dict()
+        target_files = dict()
+        for child in await list_children(client, target_drive_id, target_id):
+            if child.is_folder:
+                # OneDrive 的名称不区分大小写，以 casefold 后的名称为键
+                target_children[child.name.casefold()] = child.id
+                id2Name[f'{target_drive_id}:{child.id}'] = child.name
+            elif skip_existing:
+                target_files[child.name.casefold()] = child.size
+        target_children_cache[target_id] = target_children
+        if skip_existing:
+            target_files_cache[target_id] = target_files
+
+    # 目标文件夹中已存在同名文件时计为跳过并返回 True
+    def is_existing(item, target_id):
+        target_files = target_files_cache.get(target_id, None)
+        if not target_files or item.name.casefold() not in target_files:
+            return False
+        target_size = target_files[item.name.casefold()]
+        if item.is_folder:
+            progress.print(f"[yellow]目标中已存在与文件夹 {escape_markup(item.name)} 同名的文件，已跳过该文件夹[/]")
+        elif target_size != item.size:
+            progress.print(f"[yellow]目标中已存在同名文件 {escape_markup(item.name)}，大小不同（源 {item.size}，目标 {target_size}），已跳过[/]")
+        progress.incr("skipped")
+        return True
+
+    async def plan_folder_task_func(task):
+        item, source_parent_id = task
+        target_parent_id = target_map[source_parent_id]
+        target_parent_children = target_children_cache.get(target_parent_id, None)
         if target_parent_children is None:
-            target_parent_children = dict()
-            result = await client.drives.by_drive_id(target_drive_id).items.by_drive_item_id(target_parent_item.id).children.get()
-            while True:
-                if result and getattr(result, "value", None):
-                    for child in (result.value or []):
-                        if getattr(child, "folder", None):
-                            target_parent_children[child.name] = child
-                        id2Name[f'{target_drive_id}:{child.id}'] = child.name
-                next_link = getattr(result, "odata_next_link", None) if result else None
-                if not next_link:
-                    break
-                result = await client.drives.by_drive_id(target_drive_id).items.by_drive_item_id(target_parent_item.id).children.with_url(next_link).get()
-            target_children_cache[target_parent_item.id] = target_parent_children
-        # 如果源项是文件，则直接添加到待复制列表
-        if getattr(item, "file", None):
-            total_count += 1
-            print_status()
-            waiting_copy.append((item, target_parent_item))
-        # 如果源项是文件夹，则在目标位置创建对应的文件夹（如果不存在），并遍历其子项
-        if getattr(item, "folder", None):
-            target_item = target_parent_children.get(item.name, None)
-            if target_item is None:
-                target_item = await client.drives.by_drive_id(target_drive_id).items.by_drive_item_id(target_parent_item.id).children.post(DriveItem(name=item.name, folder=Folder()))
-            # 遍历源项的子项
-            result = await client.drives.by_drive_id(source_drive_id).items.by_drive_item_id(item.id).children.get()
-            while True:
-                if result and getattr(result, "value", None):
-                    for child in (result.value or []):
-                        if getattr(child, 'file', None):
-                            # 文件，直接添加到待复制列表
-                            total_count += 1
-                            print_status()
-                            waiting_copy.append((child, target_item))
-                        if getattr(child, 'folder', None):
-                            # 文件夹，添加到任务队列，继续遍历
-                            await traverse_executor.add_task((child, target_item))
-                        id2Name[f'{source_drive_id}:{getattr(child, "id")}'] = getattr(child, 'name')
-                next_link = getattr(result, "odata_next_link", None) if result else None
-                if not next_link:
-                    break
-                result = await client.drives.by_drive_id(source_drive_id).items.by_drive_item_id(item.id).children.with_url(next_link).get()
-        
-    traverse_executor.task_func = traverse_task_func
-    
-    live.start()
-    await traverse_executor.add_task((source_item, target_parent_item))
-    await traverse_executor.join()
-    await traverse_executor.shutdown()
+            raise RuntimeError(f"无法列举目标文件夹 {id2Name.get(f'{target_drive_id}:{target_parent_id}', target_parent_id)}")
+        target_id = target_parent_children.get(item.name.casefold(), None)
+        if target_id is None:
+            if is_existing(item, target_parent_id):
+                progress.incr("total")
+                return
+            if WHOLE_FOLDER_COPY:
+                progress.incr("total")
+                waiting_copy.append((item, source_parent_id))
+                return
+            if plan is None:
+                target_id = await create_target_folder(client, target_drive_id, target_parent_id, item.name)
+            else:
+                # 只写入计划，以占位 id 代替，执行计划时按层创建
+                target_id = PLANNED_FOLDER_PREFIX + item.id
+                plan.add("create_folder", key=target_id, name=item.name, parent=target_parent_id, depth=depth)
+                id2Name[f'{target_drive_id}:{target_id}'] = item.name
+            created_ids.add(target_id)
+            # 记入缓存，重试时不会重复创建；新建的文件夹没有子项
+            target_parent_children[item.name.casefold()] = target_id
+            target_children_cache[target_id] = dict()
+            target_files_cache[target_id] = dict()
+        # 目标文件夹已存在或刚创建，列举源文件夹的子项：文件直接添加到待复制列表，文件夹留到下一层处理
+        if skip_existing and target_id not in target_children_cache:
+            # 与源文件夹同时列举已存在的目标文件夹，以便跳过其中已有的文件
+            children, _ = await asyncio.gather(list_children(client, source_drive_id, item.id), list_target_task_func(target_id))
+        else:
+            children = await list_children(client, source_drive_id, item.id)
+        target_map[item.id] = target_id
+        for child in children:
+            if child.is_folder:
+                next_level.append((child, item.id))
+            else:
+                progress.incr("total")
+                if not is_existing(child, target_id):
+                    waiting_copy.append((child, item.id))
+
+    # 处理失败的源文件夹计为失败并以 walk 任务写入死信文件，重新执行时重新遍历该文件夹并与目标合并
+    # plan 模式下不写入死信文件，计划不包含这些文件夹，需重新生成计划
+    retry_policy = RetryPolicy(max_attempts=MAX_ATTEMPTS)
+    def encode_walk(task):
+        item, source_parent_id = task
+        return {"type": "walk", "source_drive_id": source_drive_id, "target_drive_id": target_drive_id, "item": item, "target_parent_id": target_map[source_parent_id]}
+    # 目标文件夹列举失败时，其下的源文件夹在处理时失败，由 on_plan_failed 记录
+    def on_list_failed(target_id, e):
+        progress.print(f"[bold red]列举目标文件夹 {escape_markup(id2Name.get(f'{target_drive_id}:{target_id}', target_id))} 失败: {escape_markup(e)}[/]")
+    def on_plan_failed(task, e):
+        progress.print(f"[bold red]处理源文件夹 {escape_markup(task[0].name or task[0].id)} 失败，其下的项目未复制: {escape_markup(e)}[/]")
+        progress.incr("total")
+        progress.incr("failed")
+
+    progress.start()
+    id2Name[f'{target_drive_id}:{target_parent_item.id}'] = target_parent_item.name
+    source_record = ItemRecord.from_drive_item(source_item)
+    if source_record.is_folder:
+        next_level.append((source_record, None))
+    else:
+        progress.incr("total")
+        if skip_existing:
+            await call_with_retry(list_target_task_func, target_parent_item.id, retry_policy=retry_policy, timeout=TASK_TIMEOUT)
+        if not is_existing(source_record, target_parent_item.id):
+            waiting_copy.append((source_record, None))
+    while next_level:
+        # 子项只在其父文件夹处理成功（target_map 已记录）后才加入，父文件夹处理失败时其子项不会出现在这里
+        level = next_level
+        next_level = []
+        depth += 1
+        # 只列举本次运行之前已存在的目标父文件夹
+        to_list = {target_map[parent_id] for _, parent_id in level}
+        to_list = {target_id for target_id in to_list if target_id not in created_ids and target_id not in target_children_cache}
+        list_executor = AsyncTaskExecutor(CONCURRENCY, list_target_task_func, retry_policy=retry_policy, task_timeout=TASK_TIMEOUT, on_dead_letter=on_list_failed)
+        await list_executor.add_tasks(to_list)
+        await list_executor.shutdown()
+        plan_executor = AsyncTaskExecutor(CONCURRENCY, plan_folder_task_func, retry_policy=retry_policy, task_timeout=TASK_TIMEOUT, dead_letter_path=dead_letter_path if plan is None else None, task_encoder=encode_walk, on_dead_letter=on_plan_failed)
+        await plan_executor.add_tasks(level)
+        await plan_executor.shutdown()
+        # 只有下一层的父文件夹还会被查询，其余的缓存（本层的父文件夹、没有子文件夹的已存在或新建的文件夹）全部释放，
+        # 内存占用只与相邻两层的规模有关
+        next_parents = {target_map[parent_id] for _, parent_id in next_level}
+        for cache in (target_children_cache, target_files_cache):
+            for target_id in [target_id for target_id in cache if target_id not in next_parents]:
+                del cache[target_id]
+    progress.finish_discovery()
+
+    # 开始逐个复制，源父文件夹 id 在此时映射为目标父文件夹 id，待复制的项加入时其父文件夹必然已在 target_map 中
+    def copy_tasks():
+        for item, source_parent_id in waiting_copy:
+            yield item, target_map[source_parent_id]
+
+    # 需要校验时记录已提交但尚未确认完成的文件，校验时重新列举以等待其完成
+    in_flight = set() if plan is None and (VERIFY_AFTER_COPY if verify is None else verify) else None
+    if plan is None:
+        await run_copy_tasks(client, source_drive_id, target_drive_id, copy_tasks(), progress, conflict_behavior, dead_letter_path, in_flight)
+    else:
+        for item, target_parent_id in copy_tasks():
+            plan.add("copy", item=item, target_parent=target_parent_id)
+            progress.incr("copied")
+        # 中断时遍历不完整，不生成计划
+        plan.close(discard=interrupt_handler.interrupted)
+    waiting_copy.close()
+    await progress.stop()
+    if plan is not None and not interrupt_handler.interrupted:
+        print_message(f"执行计划已写入 {plan_path} ，共 {plan.count} 个操作。", PROGRESS_MODE, name)
+        if progress.counts["failed"]:
+            print_message(f"{progress.counts['failed']} 个源文件夹处理失败，计划中不包含其下的项目，请重新生成计划。", PROGRESS_MODE, name)
+    if in_flight is not None and not interrupt_handler.interrupted:
+        await verify_copy(client, source_drive_id, source_record, target_drive_id, target_parent_item.id, dead_letter_path=dead_letter_path, name=name, in_flight=in_flight)
+
+
+async def apply_plan(client: GraphServiceClient, path: str, conflict_behavior: str = None, dead_letter_path: str = None, name: str = None, verify: bool = None):
+    """
+    执行 copy_files 生成的计划：先按层并发创建计划中的文件夹，再并发复制，不再列举源与目标。
+    conflict_behavior 为 None 时使用生成计划时的配置，失败的复制任务与直接运行时一样写入死信文件。
+    verify 为 None 时使用 VERIFY_AFTER_COPY，为 True 时执行完成后校验目标与源是否一致。
+    """
+    header = read_plan_header(path, "copy_files")
+    source_drive_id = header["source_drive_id"]
+    target_drive_id = header["target_drive_id"]
+    conflict_behavior = conflict_behavior or header.get("conflict_behavior")
+    retry_policy = RetryPolicy(max_attempts=MAX_ATTEMPTS)
+
+    # 待创建的文件夹按层分组，同一层的父文件夹都已在上一层创建
+    levels = dict()
+    copy_count = 0
+    for action in read_plan_actions(path):
+        if action["action"] == "create_folder":
+            levels.setdefault(action["depth"], []).append(action)
+        elif action["action"] == "copy":
+            copy_count += 1
+
+    progress = create_progress(name)
+    progress.start()
+    progress.incr("total", copy_count)
+    progress.finish_discovery()
+
+    # 占位 id -> 实际创建的文件夹 id
+    created = dict()
+    def resolve(target_id):
+        if target_id.startswith(PLANNED_FOLDER_PREFIX):
+            return created.get(target_id, None)
+        return target_id
+
+    async def create_task_func(action):
+        parent_id = resolve(action["parent"])
+        if parent_id is None:
+            raise RuntimeError("父文件夹创建失败")
+        created[action["key"]] = await create_target_folder(client, target_drive_id, parent_id, action["name"])
+    def on_create_failed(action, e):
+        progress.print(f"[bold red]创建文件夹 {escape_markup(action['name'])} 失败，其下的项目不会被复制: {escape_markup(e)}[/]")
+
+    for depth in sorted(levels):
+        create_executor = AsyncTaskExecutor(CONCURRENCY, create_task_func, retry_policy=retry_policy, task_timeout=TASK_TIMEOUT, on_dead_letter=on_create_failed)
+        await create_executor.add_tasks(levels[depth])
+        await create_executor.shutdown()
+
+    def copy_tasks():
+        for action in read_plan_actions(path, "copy"):
+            item = ItemRecord(*action["item"])
+            target_parent_id = resolve(action["target_parent"])
+            if target_parent_id is None:
+                progress.print(f"[bold red]复制{'文件夹' if item.is_folder else '文件'} {escape_markup(item.name or item.id)} 失败: 目标父文件夹创建失败[/]")
+                progress.incr("failed")
+                continue
+            yield item, target_parent_id
+
+    in_flight = set() if (VERIFY_AFTER_COPY if verify is None else verify) else None
+    await run_copy_tasks(client, source_drive_id, target_drive_id, copy_tasks(), progress, conflict_behavior, dead_letter_path, in_flight)
+    await progress.stop()
+    if in_flight is not None and not interrupt_handler.interrupted:
+        await verify_copy(client, source_drive_id, ItemRecord(*header["source"]), target_drive_id, header["target_parent_id"], dead_letter_path=dead_letter_path, name=name, in_flight=in_flight)
+
+
+def compare_items(source: ItemRecord, target: ItemRecord):
+    """
+    比较源项与目标项，一致时返回 None，否则返回原因：type 类型不同，size 大小不同，hash 内容不同。
+    任一方缺少 quickXorHash 时只比较大小。
+    """
+    if source.is_folder or target.is_folder:
+        return None if source.is_folder == target.is_folder else "type"
+    if source.size != target.size:
+        return "size"
+    if source.quick_xor_hash and target.quick_xor_hash and source.quick_xor_hash != target.quick_xor_hash:
+        return "hash"
+    return None
 
-    # 开始将文件逐个复制到目标位置
+
+async def verify_copy(client: GraphServiceClient, source_drive_id: str, source_root: ItemRecord, target_drive_id: str, target_parent_id: str, report_path: str = None, requeue: bool = None, dead_letter_path: str = None, name: str = None, in_flight: set = None):
+    """
+    校验复制结果：并发遍历源与目标子树，只请求大小与哈希字段，按相对路径（与 OneDrive 一样不区分大小写）边遍历边配对比较，内存中只保留尚未配对的项。
+    不一致与缺失的项写入 report_path，requeue 为 True 时以 replace 重新复制；为 None 时使用对应的配置项。
+    in_flight 为刚提交、可能仍在服务端复制中的文件的源 id，这些文件不一致或缺失时按 VERIFY_RECHECK_PASSES 重新列举其目标父文件夹后再判断。
+    目标中多出的项不视为错误。返回报告中的条目数。
+    """
+    report_path = report_path or VERIFY_REPORT_PATH
+    requeue = VERIFY_REQUEUE if requeue is None else requeue
+    progress = ProgressReporter(
+        [("source", "源文件", "bold blue"), ("matched", "一致", "bold green"), ("mismatched", "不一致", "bold yellow"), ("missing", "缺失", "bold red")],
+        total_key="source",
+        done_keys=("matched", "mismatched", "missing"),
+        mode=PROGRESS_MODE,
+        interval=PROGRESS_INTERVAL,
+        name=name,
+    )
+    retry_policy = RetryPolicy(max_attempts=MAX_ATTEMPTS)
+    # 以下的键均为 casefold 后的相对路径
+    # 尚未在另一方出现的项，相对路径 -> WalkEntry
+    pending_source = dict()
+    pending_target = dict()
+    # 目标中的文件夹，相对路径 -> id，用于为缺失的项找到目标父文件夹
+    target_folders = dict()
+    # 列举失败的目标文件夹，其下的源项无法判断是否缺失
+    failed_target_paths = set()
+    requeue_tasks = []
+    report_count = 0
+    # 等待重新列举的文件，相对路径 -> (源路径, 源项, 目标项或 None)
+    recheck = dict()
+
+    def parent_path(path):
+        return path.rsplit("/", 1)[0] if "/" in path else ""
+
+    def ancestors(path):
+        while path:
+            path = parent_path(path)
+            yield path
+
+    with open(report_path, "w", encoding="utf-8") as report:
+        def add_report(path, reason, source, target = None):
+            nonlocal report_count
+            report_count += 1
+            report.write(json.dumps({"path": path, "reason": reason, "source": source, "target": target}, ensure_ascii=False) + "\n")
+
+        def check(path, source, target):
+            reason = compare_items(source, target)
+            if reason not in (None, "type") and source.is_file and in_flight and source.id in in_flight:
+                recheck[path.casefold()] = (path, source, target)
+                return
+            if reason is None:
+                if source.is_file:
+                    progress.incr("matched")
+                return
+            add_report(path, reason, source, target)
+            if source.is_file:
+                progress.incr("mismatched")
+            if reason != "type" and target.parent_id:
+                requeue_tasks.append((source, target.parent_id))
+
+        async def consume(entries, is_source):
+            mine, other = (pending_source, pending_target) if is_source else (pending_target, pending_source)
+            async for entry in entries:
+                if is_source and entry.record.is_file:
+                    progress.incr("source")
+                key = entry.path.casefold()
+                if not is_source and entry.record.is_folder:
+                    target_folders[key] = entry.record.id
+                counterpart = other.pop(key, None)
+                if counterpart is None:
+                    mine[key] = entry
+                elif is_source:
+                    check(entry.path, entry.record, counterpart.record)
+                else:
+                    check(counterpart.path, counterpart.record, entry.record)
+
+        def on_source_failed(entry, e):
+            progress.print(f"[bold red]列举源文件夹 {escape_markup(entry.path or entry.record.name)} 失败，其下的项目未校验: {escape_markup(e)}[/]")
+        def on_target_failed(entry, e):
+            failed_target_paths.add(entry.path.casefold())
+            progress.print(f"[bold red]列举目标文件夹 {escape_markup(entry.path or entry.record.name)} 失败，其下的项目未校验: {escape_markup(e)}[/]")
+
+        progress.start()
+        # 列举失败时直接抛出，不能当作目标缺失
+        target_siblings = await call_with_retry(list_children, client, target_drive_id, target_parent_id, VERIFY_SELECT, retry_policy=retry_policy, timeout=TASK_TIMEOUT)
+        target_root = next((child for child in target_siblings if child.name.casefold() == source_root.name.casefold()), None)
+        if target_root is None or target_root.is_folder != source_root.is_folder:
+            # 目标中没有对应项或类型不同，无需遍历
+            add_report("", "missing" if target_root is None else "type", source_root, target_root)
+            if target_root is None:
+                requeue_tasks.append((source_root, target_parent_id))
+        else:
+            target_folders[""] = target_root.id
+            await asyncio.gather(
+                consume(walk(client, source_drive_id, source_root, concurrency=CONCURRENCY, select=VERIFY_SELECT, retry_policy=retry_policy, task_timeout=TASK_TIMEOUT, on_error=on_source_failed), True),
+                consume(walk(client, target_drive_id, target_root, concurrency=CONCURRENCY, select=VERIFY_SELECT, retry_policy=retry_policy, task_timeout=TASK_TIMEOUT, on_error=on_target_failed), False),
+            )
+        progress.finish_discovery()
+
+        if interrupt_handler.interrupted:
+            await progress.stop()
+            print_message("校验已中断，结果不完整。", PROGRESS_MODE, name)
+            return report_count
+
+        # 剩余的源项在目标中缺失，只报告与重新复制最上层的缺失项，其下的项随之复制
+        missing = set()
+        for key in sorted(pending_source):
+            path, source = pending_source[key].path, pending_source[key].record
+            if key in failed_target_paths or any(p in failed_target_paths for p in ancestors(key)):
+                continue
+            if source.is_file and in_flight and source.id in in_flight and parent_path(key) in target_folders:
+                recheck[key] = (path, source, None)
+                continue
+            if source.is_file:
+                progress.incr("missing")
+            if any(p in missing for p in ancestors(key)):
+                continue
+            missing.add(key)
+            add_report(path, "missing", source)
+            target_parent = target_folders.get(parent_path(key), None)
+            if target_parent is not None:
+                requeue_tasks.append((source, target_parent))
+
+        # 仍在复制中的文件：等待后重新列举其目标父文件夹，每个文件夹一次请求，不逐个查询文件
+        async def recheck_task_func(folder_key):
+            for child in await list_children(client, target_drive_id, target_folders[folder_key], VERIFY_SELECT):
+                key = f"{folder_key}/{child.name.casefold()}" if folder_key else child.name.casefold()
+                if key in recheck:
+                    path, source, _ = recheck[key]
+                    if compare_items(source, child) is None:
+                        del recheck[key]
+                        progress.incr("matched")
+                    else:
+                        recheck[key] = (path, source, child)
+        def on_recheck_failed(folder_key, e):
+            progress.print(f"[bold red]重新列举目标文件夹 {escape_markup(folder_key)} 失败: {escape_markup(e)}[/]")
+        for _ in range(VERIFY_RECHECK_PASSES):
+            if not recheck or interrupt_handler.interrupted:
+                break
+            await asyncio.sleep(COPY_MONITOR_INTERVAL)
+            recheck_executor = AsyncTaskExecutor(CONCURRENCY, recheck_task_func, retry_policy=retry_policy, task_timeout=TASK_TIMEOUT, on_dead_letter=on_recheck_failed)
+            await recheck_executor.add_tasks({parent_path(path) for path in recheck})
+            await recheck_executor.shutdown()
+        # 多次列举后仍不一致或缺失的文件按最后一次的结果报告
+        for key, (path, source, target) in recheck.items():
+            if target is None:
+                progress.incr("missing")
+                add_report(path, "missing", source)
+                requeue_tasks.append((source, target_folders[parent_path(key)]))
+            else:
+                progress.incr("mismatched")
+                add_report(path, compare_items(source, target), source, target)
+                if target.parent_id:
+                    requeue_tasks.append((source, target.parent_id))
+    await progress.stop()
+    print_message(f"校验完成，{report_count} 个项目不一致或缺失" + (f"，详情见 {report_path}" if report_count else ""), PROGRESS_MODE, name)
+
+    if requeue and requeue_tasks:
+        print_message(f"正在重新复制 {len(requeue_tasks)} 个项目 ...", PROGRESS_MODE, name)
+        copy_progress = create_progress(name)
+        copy_progress.start()
+        copy_progress.incr("total", len(requeue_tasks))
+        copy_progress.finish_discovery()
+        await run_copy_tasks(client, source_drive_id, target_drive_id, requeue_tasks, copy_progress, "replace", dead_letter_path)
+        await copy_progress.stop()
+    return report_count
+
+
+async def run_copy_tasks(client: GraphServiceClient, source_drive_id: str, target_drive_id: str, tasks, progress: ProgressReporter, conflict_behavior: str = None, dead_letter_path: str = None, in_flight: set = None):
+    """
+    执行复制任务，任务为 (源项记录, 目标父文件夹 id)，或带有监视地址的 (源项记录, 目标父文件夹 id, 监视地址)，后者服务端已接受，只跟踪不再复制。
+    失败的任务按重试策略重试，仍失败的写入死信文件，可通过 REPLAY_DEAD_LETTER_PATH 重新执行。
+    第一次中断后不再提交新的复制，已提交的复制继续跟踪到完成；强制中止时尚未完成的复制连同监视地址写入死信文件，重新执行时继续跟踪而不是再次复制。
+    服务端异步复制时（202）返回监视地址，文件夹的监视地址记录下来，全部提交后统一跟踪到完成或失败。
+    文件的复制提交后不再跟踪，计为复制中；in_flight 不为 None 时将这些文件的源 id 加入其中，由 verify_copy 重新列举确认。
+    服务端无法复制的文件在全部提交后改为流式复制，无法复制的文件夹在目标中创建后展开为子项，下一轮继续复制，见 STREAM_COPY_FALLBACK。
+    """
+    from msgraph.generated.models.item_reference import ItemReference
+    from msgraph.generated.drives.item.items.item.copy.copy_post_request_body import CopyPostRequestBody
+    conflict_behavior = conflict_behavior or CONFLICT_BEHAVIOR
+    dead_letter_path = dead_letter_path or DEAD_LETTER_PATH
+    skip_existing = conflict_behavior == "fail"
+    retry_policy = RetryPolicy(max_attempts=MAX_ATTEMPTS)
+    def encode_task(task):
+        item, target_parent_id = task[:2]
+        record = {"source_drive_id": source_drive_id, "target_drive_id": target_drive_id, "item": item, "target_parent_id": target_parent_id}
+        if len(task) > 2:
+            record["monitor_url"] = task[2]
+        return record
+    def on_copy_failed(task, e):
+        item, target_parent_id = task[:2]
+        progress.print(f"[bold red]复制{'文件夹' if item.is_folder else '文件'} {escape_markup(item.name or item.id)} -> 目标父项 {escape_markup(id2Name.get(f'{target_drive_id}:{target_parent_id}', target_parent_id))} 失败: {escape_markup(e)}[/]")
+        progress.incr("failed")
+    def on_tracked_failed(task, e):
+        progress.incr("copying", -1)
+        on_copy_failed(task, e)
+
+    # 服务端无法复制的文件夹（见 STREAM_COPY_FALLBACK），本轮结束后展开，其子项作为下一轮的复制任务
+    expansions = []
+    # 监视地址报告复制失败的文件，在下一轮流式复制
+    pending_streams = []
     async def copy_task_func(task):
-        nonlocal copying_count, copied_count, failed_count
-        item, target_parent_item = task
+        if len(task) > 2:
+            # 死信中记录的已接受的复制，只需继续跟踪
+            progress.incr("copying")
+            monitors.append(task)
+            return
+        item, target_parent_id = task
+        body = CopyPostRequestBody(
+            name=item.name,
+            parent_reference=ItemReference(
+                drive_id=target_drive_id,
+                id=target_parent_id
+            ),
+            additional_data={
+                "@microsoft.graph.conflictBehavior": conflict_behavior
+            }
+        )
         try:
-            body = CopyPostRequestBody(
-                name=getattr(item, "name"),
-                parent_reference=ItemReference(
-                    drive_id=target_drive_id,
-                    id=target_parent_item.id
-                ),
-                additional_data={
-                    "@microsoft.graph.conflictBehavior": CONFLICT_BEHAVIOR
-                }
-            )
-            copied_file = await client.drives.by_drive_id(source_drive_id).items.by_drive_item_id(item.id).copy.post(body)
-            if copied_file and getattr(copied_file, "id", None):
-                copied_count += 1
+            monitor_url = await post_copy_with_monitor(client, source_drive_id, item.id, body)
+        except Exception as e:
+            if not STREAM_COPY_FALLBACK or get_status_code(e) not in STREAM_FALLBACK_STATUS_CODES:
+                raise
+            if item.is_folder:
+                expansions.append(task)
+                return
+            # 服务端无法复制该文件，复制任务全部提交后再流式复制，不受单个任务超时的限制
+            progress.incr("copying")
+            streams.append(task)
+            return
+        if monitor_url and item.is_folder:
+            progress.incr("copying")
+            monitors.append((item, target_parent_id, monitor_url))
+        elif monitor_url:
+            # 逐个轮询文件的复制进度代价过高，只记录下来由校验确认
+            progress.incr("copying")
+            if in_flight is not None:
+                in_flight.add(item.id)
+        else:
+            # 没有监视地址时服务端已同步完成或无法跟踪，计为已复制
+            progress.incr("copied")
+
+    # 从源下载并上传到目标，分块各自重试，整个文件仍失败时按重试策略重新开始
+    async def stream_task_func(task):
+        item, target_parent_id = task
+        await stream_copy_file(client, source_drive_id, item, target_drive_id, target_parent_id, conflict_behavior)
+        progress.incr("copying", -1)
+        progress.incr("copied")
+
+    # 跟踪异步复制的进度，直到完成或失败
+    http_client = shared_transport.rest_client()
+    async def monitor_task_func(task):
+        item, target_parent_id, monitor_url = task
+        try:
+            await wait_copy_monitor(http_client, monitor_url)
+        except CopyFailedError:
+            if not STREAM_COPY_FALLBACK:
+                raise
+            # 服务端复制失败，文件改为流式复制，文件夹展开后逐个复制其子项
+            if item.is_folder:
+                progress.incr("copying", -1)
+                expansions.append((item, target_parent_id))
+            else:
+                pending_streams.append((item, target_parent_id))
+            return
+        progress.incr("copying", -1)
+        progress.incr("copied")
+
+    # 在目标中找到或创建同名文件夹（服务端复制失败时可能已创建了一部分），再列举源文件夹的子项作为下一轮的复制任务。
+    # 目标中已存在的子文件夹同样展开合并，冲突时失败的情况下跳过目标中已存在的同名文件
+    async def expand_task_func(task):
+        item, target_parent_id = task
+        target_id = None
+        for child in await list_children(client, target_drive_id, target_parent_id):
+            if child.is_folder and child.name.casefold() == item.name.casefold():
+                target_id = child.id
+                break
+        existing_folders = dict()
+        existing_files = set()
+        if target_id is None:
+            target_id = await create_target_folder(client, target_drive_id, target_parent_id, item.name)
+        else:
+            id2Name[f'{target_drive_id}:{target_id}'] = item.name
+            for child in await list_children(client, target_drive_id, target_id):
+                if child.is_folder:
+                    existing_folders[child.name.casefold()] = child.id
+                else:
+                    existing_files.add(child.name.casefold())
+        children = await list_children(client, source_drive_id, item.id)
+        # 文件夹本身不再计数，以其子项代替
+        progress.incr("total", len(children) - 1)
+        for child in children:
+            if child.is_folder and child.name.casefold() in existing_folders:
+                expansions.append((child, target_id))
+            elif child.is_file and skip_existing and child.name.casefold() in existing_files:
+                progress.incr("skipped")
             else:
-                copying_count += 1
-            print_status()
+                next_tasks.append((child, target_id))
+
+    while True:
+        streams = pending_streams
+        pending_streams = []
+        # 待跟踪的复制 (源项记录, 目标父文件夹 id, 监视地址)，大量文件异步复制时溢出到临时文件
+        monitors = SpillList(SPILL_THRESHOLD, decode=lambda row: (ItemRecord(*row[0]), row[1], row[2]))
+        copy_executor = AsyncTaskExecutor(CONCURRENCY, copy_task_func, retry_policy=retry_policy, task_timeout=TASK_TIMEOUT, dead_letter_path=dead_letter_path, task_encoder=encode_task, on_dead_letter=on_copy_failed)
+        await copy_executor.add_tasks(tasks)
+        await copy_executor.shutdown()
+
+        if streams:
+            stream_executor = AsyncTaskExecutor(STREAM_CONCURRENCY, stream_task_func, retry_policy=retry_policy, dead_letter_path=dead_letter_path, task_encoder=encode_task, on_dead_letter=on_tracked_failed)
+            await stream_executor.add_tasks(streams)
+            await stream_executor.shutdown()
+
+        if monitors:
+            monitor_executor = AsyncTaskExecutor(CONCURRENCY, monitor_task_func, retry_policy=retry_policy, dead_letter_path=dead_letter_path, task_encoder=encode_task, on_dead_letter=on_tracked_failed, use_budget=False, abort_only=True)
+            await monitor_executor.add_tasks(monitors)
+            await monitor_executor.shutdown()
+        monitors.close()
+
+        if not expansions and not pending_streams:
+            break
+        if interrupt_handler.interrupted:
+            # 尚未展开的文件夹与尚未流式复制的文件写入死信文件，重新执行时从头复制
+            for task in expansions + pending_streams:
+                write_dead_letter(dead_letter_path, encode_task(task), "cancelled", 0)
+            break
+        next_tasks = []
+        expanding = expansions
+        expansions = []
+        if expanding:
+            expand_executor = AsyncTaskExecutor(CONCURRENCY, expand_task_func, retry_policy=retry_policy, task_timeout=TASK_TIMEOUT, dead_letter_path=dead_letter_path, task_encoder=encode_task, on_dead_letter=on_copy_failed)
+            await expand_executor.add_tasks(expanding)
+            await expand_executor.shutdown()
+        tasks = next_tasks
+
+
+async def replay_dead_letters(client: GraphServiceClient, path: str, conflict_behavior: str = None, dead_letter_path: str = None, name: str = None):
+    """
+    重新执行死信文件中记录的复制任务，walk 任务对应遍历失败或未遍历的源文件夹，重新遍历后与目标中已有的内容合并
+    """
+    dead_letter_path = dead_letter_path or DEAD_LETTER_PATH
+    tasks = dict()
+    walks = []
+    for task in read_dead_letters(path):
+        if task.get("type") == "walk":
+            walks.append(task)
+            continue
+        key = (task["source_drive_id"], task["target_drive_id"])
+        if "monitor_url" in task:
+            tasks.setdefault(key, []).append((ItemRecord(*task["item"]), task["target_parent_id"], task["monitor_url"]))
+        else:
+            tasks.setdefault(key, []).append((ItemRecord(*task["item"]), task["target_parent_id"]))
+    # 死信文件与本次输出为同一文件时，清空后再记录本次的失败
+    if path == dead_letter_path:
+        open(path, "w", encoding="utf-8").close()
+
+    if tasks:
+        progress = create_progress(name)
+        progress.start()
+        progress.incr("total", sum(len(group) for group in tasks.values()))
+        progress.finish_discovery()
+        for (source_drive_id, target_drive_id), group in tasks.items():
+            await run_copy_tasks(client, source_drive_id, target_drive_id, group, progress, conflict_behavior, dead_letter_path)
+        await progress.stop()
+
+    retry_policy = RetryPolicy(max_attempts=MAX_ATTEMPTS)
+    for task in walks:
+        item = ItemRecord(*task["item"])
+        if interrupt_handler.interrupted:
+            write_dead_letter(dead_letter_path, task, "cancelled", 0)
+            continue
+        try:
+            source_item = await call_with_retry(client.drives.by_drive_id(task["source_drive_id"]).items.by_drive_item_id(item.id).get, retry_policy=retry_policy, timeout=TASK_TIMEOUT)
+            target_parent_item = await call_with_retry(client.drives.by_drive_id(task["target_drive_id"]).items.by_drive_item_id(task["target_parent_id"]).get, retry_policy=retry_policy, timeout=TASK_TIMEOUT)
         except Exception as e:
-            live.console.print(f"[bold red]复制文件 {getattr(item, 'name', item.id)} -> 目标父项 {id2Name.get(f'{target_drive_id}:{target_parent_item.id}', target_parent_item.id)} 失败: {e}[/]")
-            failed_count += 1
-            print_status()
+            print_message(f"获取源文件夹 {item.name or item.id} 或其目标父文件夹失败: {e}", PROGRESS_MODE, name)
+            write_dead_letter(dead_letter_path, task, f"{type(e).__name__}: {e}")
+            continue
+        print_message(f"正在重新遍历源文件夹 {item.name or item.id} ...", PROGRESS_MODE, name)
+        await copy_files(client, source_item, target_parent_item, conflict_behavior, dead_letter_path, name, verify=False)
+
 
-    copy_executor = AsyncTaskExecutor(CONCURRENCY, copy_task_func)
-    await copy_executor.add_tasks(waiting_copy)
-    await copy_executor.shutdown()
-    live.stop()
+async def post_copy_with_monitor(client: GraphServiceClient, drive_id: str, item_id: str, body: CopyPostRequestBody):
+    """
+    发起复制请求并返回服务端的监视地址（响应头 Location），复制为异步执行时才会返回该地址
+    """
+    from kiota_abstractions.api_error import APIError
+    from kiota_abstractions.base_request_configuration import RequestConfiguration
+    from kiota_abstractions.native_response_handler import NativeResponseHandler
+    from kiota_http.middleware.options import ResponseHandlerOption
+    request_configuration = RequestConfiguration(options=[ResponseHandlerOption(NativeResponseHandler())])
+    response = await client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).copy.post(body, request_configuration)
+    if response.status_code >= 400:
+        raise APIError(
+            message=response.text,
+            response_status_code=response.status_code,
+            response_headers=dict(response.headers),
+        )
+    return response.headers.get("Location", None)
+
+
+# 监视地址报告服务端复制失败，与请求出错不同，重试同一个复制请求通常仍会失败
+class CopyFailedError(RuntimeError):
+    pass
+
+
+async def wait_copy_monitor(http_client: httpx.AsyncClient, monitor_url: str):
+    """
+    轮询复制操作的监视地址直到完成，失败时抛出异常。监视地址自带授权，无需携带令牌。
+    单次查询遇到限流或服务端错误时按重试策略重试，不影响服务端正在进行的复制。
+    """
+    retry_policy = RetryPolicy(max_attempts=MAX_ATTEMPTS)
+    async def poll():
+        response = await http_client.get(monitor_url, follow_redirects=False)
+        raise_for_status(response, "查询复制状态")
+        return response
+    while True:
+        response = await call_with_retry(poll, retry_policy=retry_policy, timeout=TASK_TIMEOUT)
+        # 完成后部分服务端会以 303 重定向到新建的项目
+        if response.status_code == 303:
+            return
+        status = response.json().get("status", None)
+        if status == "completed":
+            return
+        if status == "failed":
+            raise CopyFailedError(f"服务端复制失败: {response.text}")
+        if status == "cancelled":
+            raise RuntimeError(f"服务端复制已取消: {response.text}")
+        await asyncio.sleep(COPY_MONITOR_INTERVAL)
 
 
-async def get_drive_item_by_path(graph_client: GraphServiceClient, driveItem: DriveItem, relative_path: str, auto_create: bool = False):
+async def list_shared_items(client: GraphServiceClient, drive_id: str):
     """
-    通过路径逐段遍历 children 来获取 DriveItem。如果auto_create为True，则在路径不存在时自动创建文件夹。
-    返回找到的 DriveItem，否则返回 None。
+    获取分享给用户的项列表（处理分页）
     """
-    try:
-        item = driveItem.remote_item if driveItem.remote_item else driveItem
-        drive_id = getattr(item.parent_reference, "drive_id")
-        normalized = (relative_path or "").strip().strip("/")
-
-        # 空路径表示根
-        if not normalized:
-            return driveItem
-
-        current_id = item.id
-        if not current_id:
-            return None
-        segments = [seg for seg in normalized.split("/") if seg]
-
-        for seg in segments:
-            found = None
-            # 获取当前节点的所有子项（处理分页）
-            if not current_id:
-                return None
-            result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(current_id).children.get()
-            while True:
-                if result and getattr(result, "value", None):
-                    for child in (result.value or []):
-                        if getattr(child, "name", None) == seg:
-                            found = child
-                            break
-                if found is not None:
-                    break
-                next_link = getattr(result, "odata_next_link", None) if result else None
-                if not next_link:
-                    break
-                result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(current_id).children.with_url(next_link).get()
-
-            # 如果开启了自动创建且found为None，则创建文件夹
-            if auto_create and found is None:
-                request_body = DriveItem(name=seg, folder = Folder())
-                found = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(current_id).children.post(request_body)
-
-            if found is None or not getattr(found, "id", None):
-                return None
-            current_id = found.id
-            id2Name[f'{drive_id}:{current_id}'] = found.name
-
-        # 返回最终节点的完整详情
-        if not current_id:
-            return None
-        final_item = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(current_id).get()
-        return final_item
-    except Exception:
-        # 让调用方决定如何提示错误，这里返回 None
-        return None
+    shared_items = []
+    result = await client.drives.by_drive_id(drive_id).shared_with_me.get()
+    while True:
+        if result and getattr(result, 'value', None):
+            shared_items.extend(getattr(result, 'value'))
+        next_link = getattr(result, 'odata_next_link', None) if result else None
+        if not next_link:
+            break
+        result = await client.drives.by_drive_id(drive_id).shared_with_me.with_url(next_link).get()
+    return shared_items
+
 
 async def main():
     """
     主函数
     """
+    if RUN_MODE not in RUN_MODES:
+        print(f"未知的 RUN_MODE: {RUN_MODE}，可选 {', '.join(RUN_MODES)}")
+        return
+
+    from fileBackedDeviceCodeCredential import FileBackedDeviceCodeCredential
+
     # 定义权限范围
     scopes = ["https://graph.microsoft.com/.default"]
 
     try:
         credential = FileBackedDeviceCodeCredential(client_id=CLIENT_ID, file_path=CREDENTIAL_FILE_PATH)
-        client = GraphServiceClient(credentials=credential, scopes=scopes)
+        # Graph 请求与复制监视共用同一个连接池
+        shared_transport.configure(CONCURRENCY)
+        client = shared_transport.create_graph_client(credential, scopes)
         target_drive = await client.me.drive.get()
         if not target_drive or not target_drive.id:
             print("无法获取用户的OneDrive信息，请检查权限配置。")
@@ -223,22 +845,37 @@ async def main():
              print("认证错误: 设备代码认证流程未完成或已超时。")
         return
 
+    if REPLAY_DEAD_LETTER_PATH:
+        print(f"正在重新执行 {REPLAY_DEAD_LETTER_PATH} 中失败的复制任务 ...")
+        interrupt_handler.install()
+        try:
+            await replay_dead_letters(client, REPLAY_DEAD_LETTER_PATH)
+        finally:
+            interrupt_handler.uninstall()
+        report_interrupted()
+        return
+
+    if RUN_MODE == "apply":
+        print(f"正在执行计划 {PLAN_PATH} ...")
+        interrupt_handler.install()
+        try:
+            await apply_plan(client, PLAN_PATH)
+        except (OSError, ValueError) as e:
+            print(f"读取执行计划失败: {e}")
+            return
+        finally:
+            interrupt_handler.uninstall()
+        report_interrupted()
+        return
+
     # 要求用户选择源项作为源相对路径的起点
     options = [{
         "label": "1. 选择我的OneDrive根目录作为起点",
         "value": await client.drives.by_drive_id(target_drive.id).root.get()
     }]
     # 获取分享给用户的项列表
-    shared_items = []
-    result = await client.drives.by_drive_id(target_drive.id).shared_with_me.get()
-    while True:
-        if result and getattr(result, 'value', None):
-            shared_items.extend(getattr(result, 'value'))
-        next_link = getattr(result, '@odata.nextLink', None) if result else None
-        if not next_link:
-            break
-        result = await client.drives.by_drive_id(target_drive.id).shared_with_me.with_url(next_link).get()
-    
+    shared_items = await list_shared_items(client, target_drive.id)
+
     for i in range(len(shared_items)):
         item = shared_items[i]
         if item and item.remote_item:
@@ -265,7 +902,8 @@ async def main():
     try:
         # 获取源项与目标项
         print(f"正在查找源路径 '{SOURCE_PATH}' ...")
-        source_item = await get_drive_item_by_path(client, selected_option['value'], SOURCE_PATH)
+        source_root = selected_option['value'].remote_item or selected_option['value']
+        source_item = await get_drive_item_by_path(client, source_root.parent_reference.drive_id, SOURCE_PATH, root_id=source_root.id)
         if source_item is None or not source_item.id:
             print(f"未找到源路径 '{SOURCE_PATH}' ，请检查路径是否正确。")
             return
@@ -273,7 +911,7 @@ async def main():
         print(f'找到源项 ID: {source_item.id}')
         
         print(f"正在查找或创建目标路径 '{TARGET_PARENT_PATH}' ...")
-        target_parent_item = await get_drive_item_by_path(client, options[0]['value'], TARGET_PARENT_PATH, auto_create=True)
+        target_parent_item = await get_drive_item_by_path(client, target_drive.id, TARGET_PARENT_PATH, auto_create=True)
         if target_parent_item is None or not target_parent_item.id:
             print(f"未找到或创建目标路径 '{TARGET_PARENT_PATH}' ，请检查路径是否正确。")
             return
@@ -284,13 +922,24 @@ async def main():
         print(f"查找路径时发生错误: {e}")
         return
 
+    # 第一次 Ctrl-C 停止提交新的复制，等待执行中的请求完成，第二次强制中止
+    interrupt_handler.install()
     try:
-        # 开始复制
-        await copy_files(client, source_item, target_parent_item)
+        # 开始复制，plan 模式下只生成执行计划
+        await copy_files(client, source_item, target_parent_item, plan_path=PLAN_PATH if RUN_MODE == "plan" else None)
     
     except Exception as e:
         print(f"复制文件时发生错误: {e}")
         return
+    finally:
+        interrupt_handler.uninstall()
+    report_interrupted()
+
+def report_interrupted():
+    if interrupt_handler.interrupted and RUN_MODE == "plan":
+        print("任务已中断，遍历不完整，未生成执行计划。")
+    elif interrupt_handler.interrupted:
+        print(f"任务已中断，未完成的复制任务与尚未遍历的文件夹已写入 {DEAD_LETTER_PATH} ，将 REPLAY_DEAD_LETTER_PATH 设置为该文件可继续执行。")
 
 if __name__ == "__main__":
     # 提示用户进行设备代码认证
@@ -0,0 +1,83 @@
+import json
+import tempfile
+from typing import NamedTuple, Optional
+
+
+# 精简的 DriveItem 记录，只保留后续阶段需要的字段，避免在内存中长期持有完整的 Kiota 模型
+# 新字段只能追加在末尾并带默认值，旧的死信与计划文件中较短的记录仍可还原
+class ItemRecord(NamedTuple):
+    id: str
+    name: str
+    parent_id: Optional[str] = None
+    drive_id: Optional[str] = None
+    is_folder: bool = False
+    size: Optional[int] = None
+    web_url: Optional[str] = None
+    e_tag: Optional[str] = None
+    quick_xor_hash: Optional[str] = None
+
+    @property
+    def is_file(self):
+        return not self.is_folder
+
+    @classmethod
+    def from_drive_item(cls, item):
+        """
+        从 DriveItem 生成记录，共享项以其 remote_item 为准
+        """
+        item = getattr(item, "remote_item", None) or item
+        parent_reference = getattr(item, "parent_reference", None)
+        hashes = getattr(getattr(item, "file", None), "hashes", None)
+        return cls(
+            id=item.id,
+            name=item.name,
+            parent_id=getattr(parent_reference, "id", None),
+            drive_id=getattr(parent_reference, "drive_id", None),
+            is_folder=getattr(item, "folder", None) is not None,
+            size=getattr(item, "size", None),
+            web_url=getattr(item, "web_url", None),
+            e_tag=getattr(item, "e_tag", None),
+            quick_xor_hash=getattr(hashes, "quick_xor_hash", None),
+        )
+
+
+# 超过阈值后溢出到磁盘的待处理列表
+class SpillList:
+    """
+    前 threshold 个元素保存在内存中，其余元素以 JSON 行的形式追加到临时文件，使内存占用不随目录树规模增长。
+    元素需可被 json 序列化（NamedTuple 会被序列化为数组），decode 用于将读回的 JSON 还原为元素。
+    """
+    def __init__(self, threshold, decode = lambda row: row):
+        self.threshold = threshold
+        self.decode = decode
+        self.memory = []
+        self.spill_file = None
+        self.spilled_count = 0
+
+    def append(self, item):
+        if self.threshold is None or len(self.memory) < self.threshold:
+            self.memory.append(item)
+            return
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+        self.spill_file.write(json.dumps(item, ensure_ascii=False) + "\n")
+        self.spilled_count += 1
+
+    def __len__(self):
+        return len(self.memory) + self.spilled_count
+
+    def __iter__(self):
+        yield from self.memory
+        if self.spill_file is not None:
+            self.spill_file.flush()
+            self.spill_file.seek(0)
+            for line in self.spill_file:
+                yield self.decode(json.loads(line))
+            self.spill_file.seek(0, 2)
+
+    def close(self):
+        self.memory = []
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.spilled_count = 0
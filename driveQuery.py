@@ -0,0 +1,24 @@
+# 列举子项时默认请求的字段，只包含各脚本实际读取的字段，减少传输量与 JSON 解析开销
+CHILDREN_SELECT = ["id", "name", "file", "folder", "size", "parentReference", "webUrl", "eTag"]
+# 复制后校验时只需要大小与 file 中的 hashes
+VERIFY_SELECT = ["id", "name", "file", "folder", "size", "parentReference"]
+# 按路径查找时只需要名称与 id
+PATH_LOOKUP_SELECT = ["id", "name", "folder"]
+# 列举子项时每页的条目数，服务端会按自身上限截断
+CHILDREN_PAGE_SIZE = 999
+
+
+def children_request_configuration(select = None, top = CHILDREN_PAGE_SIZE):
+    """
+    生成列举子项时使用的请求配置，带有 $select 与 $top 参数。
+    翻页时 odata_next_link 已包含这些参数，使用 with_url 请求下一页时无需再次传入。
+    """
+    # SDK 导入耗时较长，首次列举时才导入
+    from kiota_abstractions.base_request_configuration import RequestConfiguration
+    from msgraph.generated.drives.item.items.item.children.children_request_builder import ChildrenRequestBuilder
+    return RequestConfiguration(
+        query_parameters=ChildrenRequestBuilder.ChildrenRequestBuilderGetQueryParameters(
+            select=list(select or CHILDREN_SELECT),
+            top=top,
+        )
+    )
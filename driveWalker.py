@@ -0,0 +1,214 @@
+import asyncio
+from collections import deque
+from typing import NamedTuple
+from asyncTaskExecutor import call_with_retry, concurrency_budget, interrupt_handler
+from driveItemRecord import ItemRecord
+from driveQuery import children_request_configuration, PATH_LOOKUP_SELECT
+
+
+# 遍历登记到中断处理器的控制对象
+class WalkInterrupt:
+    """
+    第一次中断时各工作协程在取下一个文件夹前自行停止，无需额外处理；第二次中断时调用 on_abort 强制中止正在进行的列举。
+    """
+    def __init__(self, on_abort):
+        self.on_abort = on_abort
+
+    def cancel(self):
+        pass
+
+    def abort(self):
+        self.on_abort()
+
+
+# 遍历时返回的项目，path 为相对于遍历起点的路径，depth 为起点之下的层级（从 1 开始）
+class WalkEntry(NamedTuple):
+    record: ItemRecord
+    path: str
+    depth: int
+
+
+async def iter_children(graph_client, drive_id: str, item_id: str, select = None):
+    """
+    逐页列举文件夹的子项，返回 DriveItem
+    """
+    result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).children.get(children_request_configuration(select))
+    while True:
+        if result and getattr(result, "value", None):
+            for child in (result.value or []):
+                yield child
+        next_link = getattr(result, "odata_next_link", None) if result else None
+        if not next_link:
+            break
+        result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).children.with_url(next_link).get()
+
+
+async def list_children(graph_client, drive_id: str, item_id: str, select = None):
+    """
+    列举文件夹的全部子项，只返回文件与文件夹的精简记录。
+    全部分页成功后才返回，重试时不会产生重复项。
+    """
+    records = []
+    async for child in iter_children(graph_client, drive_id, item_id, select):
+        if getattr(child, "file", None) or getattr(child, "folder", None):
+            records.append(ItemRecord.from_drive_item(child))
+    return records
+
+
+async def get_drive_item_by_path(graph_client, drive_id: str, path: str, root_id: str = None, auto_create: bool = False):
+    """
+    通过路径逐段遍历 children 来获取 DriveItem，root_id 为路径的起点，为 None 时从驱动器根目录开始。
+    如果auto_create为True，则在路径不存在时自动创建文件夹。
+    返回找到的 DriveItem，否则返回 None。
+    """
+    try:
+        normalized = (path or "").strip().strip("/")
+        current_id = root_id
+        if not current_id:
+            # 获取根 DriveItem 以拿到 root 的 item_id
+            root_item = await graph_client.drives.by_drive_id(drive_id).root.get()
+            if not root_item or not getattr(root_item, "id", None):
+                return None
+            # 空路径表示根
+            if not normalized:
+                return root_item
+            current_id = root_item.id
+
+        for seg in [seg for seg in normalized.split("/") if seg]:
+            found = None
+            async for child in iter_children(graph_client, drive_id, current_id, PATH_LOOKUP_SELECT):
+                if getattr(child, "name", None) == seg:
+                    found = child
+                    break
+
+            # 如果开启了自动创建且found为None，则创建文件夹
+            if auto_create and found is None:
+                from msgraph.generated.models.drive_item import DriveItem
+                from msgraph.generated.models.folder import Folder
+                found = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(current_id).children.post(DriveItem(name=seg, folder=Folder()))
+
+            if found is None or not getattr(found, "id", None):
+                return None
+            current_id = found.id
+
+        # 返回最终节点的完整详情
+        return await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(current_id).get()
+    except Exception:
+        # 让调用方决定如何提示错误，这里返回 None
+        return None
+
+
+async def walk(
+    graph_client,
+    drive_id: str,
+    root: ItemRecord,
+    *,
+    concurrency = 10,
+    order = "bfs",
+    select = None,
+    item_filter = None,
+    descend = None,
+    max_buffer = 1000,
+    retry_policy = None,
+    task_timeout = None,
+    on_error = None,
+    on_cancelled = None,
+):
+    """
+    异步遍历 root 之下的所有文件与文件夹，逐个返回 WalkEntry；root 为文件时只返回 root 本身。
+    concurrency 个协程并发列举文件夹，order 为 bfs（广度优先）或 dfs（深度优先），select 为列举时请求的字段。
+    item_filter(entry) 为 False 的项目不返回，descend(entry) 为 False 的文件夹不再列举其子项。
+    最多缓存 max_buffer 个未被取走的项目，调用方处理得慢时遍历会随之暂停。
+    列举失败的文件夹按 retry_policy 重试，仍失败时调用 on_error(entry, exc) 并跳过，未设置 on_error 时异常抛给调用方。
+    收到中断信号后不再列举新的文件夹，再次收到时中止正在进行的列举，未列举完成的文件夹逐个调用 on_cancelled(entry)，
+    调用方可据此记录以便之后继续；未设置 on_cancelled 时这些文件夹被忽略。
+    """
+    if order not in ("bfs", "dfs"):
+        raise ValueError(f"未知的遍历顺序: {order}")
+    root_entry = WalkEntry(root, "", 0)
+    if not root.is_folder:
+        if item_filter is None or item_filter(root_entry):
+            yield root_entry
+        return
+
+    pending = deque([root_entry])
+    output = asyncio.Queue(maxsize=max_buffer)
+    condition = asyncio.Condition()
+    busy = 0
+    finished = object()
+    errors = []
+    # 工作协程序号 -> 正在列举的文件夹
+    in_flight = dict()
+
+    def report_cancelled(folders):
+        if on_cancelled is not None:
+            for folder in folders:
+                on_cancelled(folder)
+
+    async def worker(wid):
+        nonlocal busy
+        while True:
+            async with condition:
+                while not pending and busy:
+                    await condition.wait()
+                if not pending or errors or interrupt_handler.interrupted:
+                    condition.notify_all()
+                    return
+                folder = pending.popleft() if order == "bfs" else pending.pop()
+                busy += 1
+                in_flight[wid] = folder
+            subfolders = []
+            try:
+                async with concurrency_budget:
+                    children = await call_with_retry(list_children, graph_client, drive_id, folder.record.id, select, retry_policy=retry_policy, timeout=task_timeout)
+                for child in children:
+                    entry = WalkEntry(child, f"{folder.path}/{child.name}" if folder.path else child.name, folder.depth + 1)
+                    if child.is_folder and (descend is None or descend(entry)):
+                        subfolders.append(entry)
+                    if item_filter is None or item_filter(entry):
+                        await output.put(entry)
+            except Exception as e:
+                if on_error is None:
+                    errors.append(e)
+                else:
+                    on_error(folder, e)
+            finally:
+                in_flight.pop(wid, None)
+                async with condition:
+                    # 深度优先时逆序放入，使同一层的文件夹按列举顺序处理
+                    pending.extend(subfolders if order == "bfs" else reversed(subfolders))
+                    busy -= 1
+                    condition.notify_all()
+
+    workers = []
+    def abort():
+        # 被中止的文件夹视为未列举，子项在列举完成前不会返回
+        report_cancelled(list(in_flight.values()))
+        in_flight.clear()
+        for task in workers:
+            task.cancel()
+    walk_interrupt = WalkInterrupt(abort)
+    interrupt_handler.register(walk_interrupt)
+
+    async def supervisor():
+        workers.extend(asyncio.create_task(worker(i)) for i in range(concurrency))
+        await asyncio.gather(*workers, return_exceptions=True)
+        if interrupt_handler.interrupted:
+            report_cancelled(pending)
+            pending.clear()
+        await output.put(finished)
+
+    supervisor_task = asyncio.create_task(supervisor())
+    try:
+        while True:
+            entry = await output.get()
+            if entry is finished:
+                break
+            yield entry
+        await supervisor_task
+        if errors:
+            raise errors[0]
+    finally:
+        if not supervisor_task.done():
+            supervisor_task.cancel()
+            await asyncio.gather(supervisor_task, return_exceptions=True)
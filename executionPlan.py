@@ -0,0 +1,75 @@
+import json
+import os
+import time
+
+# 计划文件格式版本，格式不兼容时递增
+PLAN_VERSION = 1
+# 各脚本支持的执行模式：run 为遍历后直接执行，plan 为只遍历并写入计划文件，apply 为执行计划文件而不再遍历
+RUN_MODES = ("run", "plan", "apply")
+
+
+# 执行计划写入器
+class PlanWriter:
+    """
+    以 JSON 行写入执行计划：第一行为计划头，记录工具名与执行时需要的参数，其余每行为一个操作。
+    写入时先写到临时文件，close 时才替换目标文件，中断或出错时不会留下不完整的计划。
+    """
+    def __init__(self, path, tool, **header):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.count = 0
+        self.file = open(self.tmp_path, "w", encoding="utf-8")
+        self._write({"plan": tool, "version": PLAN_VERSION, "created": time.time(), **header})
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def add(self, action, **fields):
+        self._write({"action": action, **fields})
+        self.count += 1
+
+    def close(self, discard = False):
+        """
+        关闭并生效计划文件，discard 为 True 时丢弃已写入的内容
+        """
+        if self.file.closed:
+            return
+        self.file.close()
+        if discard:
+            os.remove(self.tmp_path)
+        else:
+            os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(discard=exc_type is not None)
+
+
+def read_plan_header(path, tool):
+    """
+    读取并校验计划头，计划不属于该工具或版本不兼容时抛出 ValueError
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+    if header.get("plan") != tool:
+        raise ValueError(f"{path} 不是 {tool} 的执行计划")
+    if header.get("version") != PLAN_VERSION:
+        raise ValueError(f"{path} 的计划版本 {header.get('version')} 不受支持，请重新生成计划")
+    return header
+
+
+def read_plan_actions(path, action = None):
+    """
+    逐个返回计划中的操作，action 不为 None 时只返回该类型的操作
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        f.readline()
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if action is None or record.get("action") == action:
+                yield record
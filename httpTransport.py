@@ -0,0 +1,93 @@
+# httpx 在第一次使用连接池时才导入，导入本模块不影响脚本的启动耗时
+
+# Graph API 的基础地址
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+# 是否启用 HTTP/2，同一主机的并发请求在少数连接上多路复用，需要安装 h2（httpx[http2]），未安装时使用 HTTP/1.1
+HTTP2 = True
+# 空闲连接保持的时间（秒），期间的新请求直接复用已建立的连接与 TLS 会话
+KEEPALIVE_EXPIRY = 120
+# 建立连接的超时时间（秒）
+CONNECT_TIMEOUT = 30
+# 读写的超时时间（秒）
+READ_TIMEOUT = 100
+# 未设置并发数时的默认值
+DEFAULT_CONCURRENCY = 10
+
+
+def raise_for_status(response, action: str):
+    """
+    响应为错误状态时抛出带状态码的 HTTPStatusError，由重试策略判断是否重试（限流与服务端错误会重试，并遵循 Retry-After）
+    """
+    if response.status_code >= 400:
+        import httpx
+        raise httpx.HTTPStatusError(f"{action}失败: HTTP {response.status_code} - {response.text}", request=response.request, response=response)
+
+
+def http2_available():
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+# 进程内共享的 HTTP 传输层
+class SharedTransport:
+    """
+    Graph 客户端与 SharePoint REST、复制监视等请求共用同一个连接池，连接与 TLS 会话在各客户端之间复用。
+    连接数上限随并发数设置，超出时请求排队等待空闲连接而不是报错，并发本身由任务执行器控制。
+    连接池在第一次使用时创建，configure 需在此之前调用。连接池随进程存在，不单独关闭各个客户端。
+    """
+    def __init__(self):
+        self.concurrency = DEFAULT_CONCURRENCY
+        self._transport = None
+        self._rest_client = None
+
+    def configure(self, concurrency):
+        if self._transport is not None:
+            raise RuntimeError("连接池已创建，无法再修改并发数")
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+
+    @property
+    def transport(self):
+        if self._transport is None:
+            import httpx
+            # 执行器之外还有遍历与复制监视等并行请求，保留一倍余量
+            limits = httpx.Limits(
+                max_connections=self.concurrency * 2,
+                max_keepalive_connections=self.concurrency,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            )
+            self._transport = httpx.AsyncHTTPTransport(http2=HTTP2 and http2_available(), limits=limits)
+        return self._transport
+
+    def timeout(self):
+        import httpx
+        # pool 为 None：等待空闲连接时不超时
+        return httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT, pool=None)
+
+    def create_graph_client(self, credential, scopes):
+        """
+        创建使用共享连接池的 GraphServiceClient，保留 SDK 默认的中间件（重试、重定向、遥测等）
+        """
+        import httpx
+        from kiota_authentication_azure.azure_identity_authentication_provider import AzureIdentityAuthenticationProvider
+        from msgraph.graph_request_adapter import GraphRequestAdapter, options
+        from msgraph.graph_service_client import GraphServiceClient
+        from msgraph_core import GraphClientFactory
+
+        http_client = httpx.AsyncClient(transport=self.transport, timeout=self.timeout(), base_url=GRAPH_BASE_URL)
+        http_client = GraphClientFactory.create_with_default_middleware(client=http_client, options=options)
+        auth_provider = AzureIdentityAuthenticationProvider(credential, scopes=scopes)
+        return GraphServiceClient(request_adapter=GraphRequestAdapter(auth_provider, client=http_client))
+
+    def rest_client(self):
+        """
+        返回不经过 Graph 中间件的普通客户端，用于 SharePoint REST 与复制监视等请求，不自动跟随重定向
+        """
+        if self._rest_client is None:
+            import httpx
+            self._rest_client = httpx.AsyncClient(transport=self.transport, timeout=self.timeout())
+        return self._rest_client
+
+shared_transport = SharedTransport()
@@ -0,0 +1,98 @@
+# 导入耗时基准：在独立的解释器中逐个导入各脚本，统计导入耗时，并检查导入时是否加载了耗时较长的 SDK
+# 任一脚本导入时加载了 HEAVY_MODULES 中的模块，或耗时中位数超过预算时以非 0 退出，可在 CI 或定时任务中发现启动变慢
+#
+# 用法: python importTimeBenchmark.py [--repeat N] [--budget 毫秒] [--detail]
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# 需要检查的脚本
+MODULES = ["copy_files", "remove_history_version", "onedrive_permission_manager", "batchRunner"]
+# 导入脚本时不应加载的模块，应在实际用到时才导入
+HEAVY_MODULES = ["msgraph", "azure.identity", "kiota_abstractions", "kiota_http", "httpx", "aiohttp", "rich"]
+# 每个脚本重复测量的次数，取中位数
+REPEAT = 5
+# 单个脚本的导入耗时预算（毫秒），包含 asyncio 等标准库的导入
+BUDGET_MS = 200
+
+MEASURE_CODE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print((time.perf_counter() - start) * 1000)
+print(",".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def measure(module: str):
+    """
+    在新的解释器中导入脚本，返回 (导入耗时毫秒, 导入时加载的重模块列表)
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", MEASURE_CODE.format(module=module, heavy=HEAVY_MODULES)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    lines = result.stdout.splitlines()
+    heavy = lines[1] if len(lines) > 1 else ""
+    return float(lines[0]), [name for name in heavy.split(",") if name]
+
+
+def slowest_imports(module: str, count: int = 10):
+    """
+    使用 -X importtime 找出脚本直接导入的模块中累计耗时最长的几个，返回 [(毫秒, 模块名)]
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        # 每深一层缩进两个空格，脚本本身为一个空格，其直接导入的模块为三个空格
+        if not name.startswith("   ") or name.startswith("     ") or not cumulative.strip().isdigit():
+            continue
+        entries.append((int(cumulative) / 1000, name.strip()))
+    return sorted(entries, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检查各脚本的导入耗时")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="每个脚本重复测量的次数")
+    parser.add_argument("--budget", type=float, default=BUDGET_MS, help="单个脚本的导入耗时预算（毫秒）")
+    parser.add_argument("--detail", action="store_true", help="列出每个脚本耗时最长的依赖")
+    args = parser.parse_args()
+
+    failed = False
+    for module in MODULES:
+        samples = []
+        heavy = []
+        for _ in range(args.repeat):
+            elapsed, heavy = measure(module)
+            samples.append(elapsed)
+        median = statistics.median(samples)
+        problems = []
+        if heavy:
+            problems.append(f"导入时加载了 {', '.join(heavy)}")
+        if median > args.budget:
+            problems.append(f"超过预算 {args.budget:.0f} ms")
+        print(f"{module:<32} {median:8.1f} ms  {'；'.join(problems) if problems else 'OK'}")
+        if args.detail or problems:
+            for cumulative, name in slowest_imports(module):
+                print(f"    {cumulative:8.1f} ms  {name}")
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,11 +4,20 @@
 # 1. Files.ReadWrite.All: 允许应用读取、创建、修改和删除所有用户的 OneDrive 文件。这是分享和遍历文件夹所必需的。
 # 2. User.Read: 允许应用读取登录用户的基本个人资料。
 
+from __future__ import annotations
+
 import asyncio
-from fileBackedDeviceCodeCredential import FileBackedDeviceCodeCredential
-from msgraph.graph_service_client import GraphServiceClient
-from msgraph.generated.models.drive_recipient import DriveRecipient
-from msgraph.generated.drives.item.items.item.invite.invite_post_request_body import InvitePostRequestBody
+from typing import TYPE_CHECKING
+from asyncTaskExecutor import AsyncTaskExecutor, RetryPolicy, get_status_code, interrupt_handler
+from driveItemRecord import ItemRecord
+from driveWalker import get_drive_item_by_path, walk
+from executionPlan import PlanWriter, RUN_MODES, read_plan_actions, read_plan_header
+from httpTransport import shared_transport
+from progressReporter import print_message
+
+# msgraph 与 azure.identity 导入耗时较长，只在用到时导入，脚本启动与被其它脚本导入时无需等待
+if TYPE_CHECKING:
+    from msgraph.graph_service_client import GraphServiceClient
 
 # --- 配置信息 ---
 # 在 Azure AD 中注册应用后获取，形如aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee
@@ -21,236 +30,229 @@ SHARE_PERMISSION = "read"
 FOLDER_PATH = "/新建文件夹"
 # 用户认证信息缓存路径，用于一段时间内免重复认证
 CREDENTIAL_FILE_PATH = "userXXX.json"
+# 递归处理时同时列举的文件夹数，执行计划时同时处理的项目数
+CONCURRENCY = 5
+# 执行计划时单个项目的最大尝试次数，遇到限流、服务端错误或网络错误时按指数退避重试
+MAX_ATTEMPTS = 5
+# 执行模式，run 为遍历后直接修改权限，plan 为只遍历并将需要的权限变更写入 PLAN_PATH，apply 为跳过交互直接执行 PLAN_PATH 中的计划
+RUN_MODE = "run"
+# 执行计划文件路径
+PLAN_PATH = "onedrive_permission_manager_plan.jsonl"
+# 输出方式，live 为直接打印，jsonl 为每行一个 JSON 事件，便于与其它任务的输出合并
+PROGRESS_MODE = "live"
 
 # 全局变量
 id2Name = dict()
 
-async def item_permissions_handler(graph_client: GraphServiceClient, drive_id: str, item_id: str):
+async def item_permissions_handler(graph_client: GraphServiceClient, drive_id: str, item_id: str, recipient_email: str = None, share_permission: str = None, plan: PlanWriter = None, name: str = None):
     """
     先查询item的权限，然后根据SHARE_PERMISSION决定是赋权还是取消赋权还是不操作，仅处理传入的item_id
+    recipient_email 与 share_permission 为 None 时使用对应的配置项，plan 不为 None 时只将需要的变更写入计划，name 用于区分同时运行的多个任务的输出
     """
-    print(f"开始处理项目：{id2Name.get(item_id, item_id)} 的权限")
+    recipient_email = recipient_email or RECIPIENT_EMAIL
+    share_permission = share_permission or SHARE_PERMISSION
+    print_message(f"开始处理项目：{id2Name.get(item_id, item_id)} 的权限", PROGRESS_MODE, name)
     try:
-        # 拉取该项的所有权限（包含分页）
-        all_permissions = []
-        result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).permissions.get()
-        while True:
-            if result and getattr(result, "value", None):
-                all_permissions.extend(result.value or [])
-            next_link = getattr(result, "odata_next_link", None) if result else None
-            if not next_link:
-                break
-            result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).permissions.with_url(next_link).get()
-
-        def identity_matches_email(identity, email):
-            if not identity or not email:
-                return False
-            email_l = email.lower()
-            user = getattr(identity, "user", None)
-            if user:
-                # IdentitySet.user.email
-                if getattr(user, "email", None):
-                    return str(user.email).lower() == email_l
-                # IdentitySet.user.additional_data['email']
-                if getattr(user, "additional_data", None) and user.additional_data.get('email', None):
-                    return str(user.additional_data['email']).lower() == email_l
-            # 某些模型可能直接有 email 字段
-            if getattr(identity, "email", None):
-                return str(identity.email).lower() == email_l
-            return False
+        delete_ids, invite_role, message = await plan_item_permissions(graph_client, drive_id, item_id, recipient_email, share_permission)
+        if not delete_ids and not invite_role:
+            print_message(message, PROGRESS_MODE, name)
+        elif plan is not None:
+            plan.add("permission", item_id=item_id, name=id2Name.get(item_id, None), delete=delete_ids, invite=invite_role)
+            print_message(f"计划{message}", PROGRESS_MODE, name)
+        else:
+            await apply_item_permissions(graph_client, drive_id, item_id, delete_ids, invite_role, recipient_email)
+            print_message(f"已{message}", PROGRESS_MODE, name)
+    except Exception as e:
+        print_message(f"处理权限时出错: {e}", PROGRESS_MODE, name)
+        raise e
+
 
-        def permission_for_email(perm, email):
-            # 单个主体
-            if identity_matches_email(getattr(perm, "granted_to_v2", None), email):
+async def plan_item_permissions(graph_client: GraphServiceClient, drive_id: str, item_id: str, recipient_email: str, share_permission: str):
+    """
+    查询item的权限并决定需要的变更，返回 (待删除的权限 id 列表, 待赋予的角色, 说明)，无需变更时前两者为空
+    """
+    # 拉取该项的所有权限（包含分页）
+    all_permissions = []
+    result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).permissions.get()
+    while True:
+        if result and getattr(result, "value", None):
+            all_permissions.extend(result.value or [])
+        next_link = getattr(result, "odata_next_link", None) if result else None
+        if not next_link:
+            break
+        result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).permissions.with_url(next_link).get()
+
+    def identity_matches_email(identity, email):
+        if not identity or not email:
+            return False
+        email_l = email.lower()
+        user = getattr(identity, "user", None)
+        if user:
+            # IdentitySet.user.email
+            if getattr(user, "email", None):
+                return str(user.email).lower() == email_l
+            # IdentitySet.user.additional_data['email']
+            if getattr(user, "additional_data", None) and user.additional_data.get('email', None):
+                return str(user.additional_data['email']).lower() == email_l
+        # 某些模型可能直接有 email 字段
+        if getattr(identity, "email", None):
+            return str(identity.email).lower() == email_l
+        return False
+
+    def permission_for_email(perm, email):
+        # 单个主体
+        if identity_matches_email(getattr(perm, "granted_to_v2", None), email):
+            return True
+        if identity_matches_email(getattr(perm, "granted_to", None), email):
+            return True
+        # 多个主体
+        for ident in getattr(perm, "granted_to_identities_v2", []) or []:
+            if identity_matches_email(ident, email):
                 return True
-            if identity_matches_email(getattr(perm, "granted_to", None), email):
+        for ident in getattr(perm, "granted_to_identities", []) or []:
+            if identity_matches_email(ident, email):
                 return True
-            # 多个主体
-            for ident in getattr(perm, "granted_to_identities_v2", []) or []:
-                if identity_matches_email(ident, email):
-                    return True
-            for ident in getattr(perm, "granted_to_identities", []) or []:
-                if identity_matches_email(ident, email):
-                    return True
-            return False
+        return False
 
-        target_perms = [p for p in all_permissions if permission_for_email(p, RECIPIENT_EMAIL)]
-        has_read = any("read" in [str(r).lower() for r in (getattr(p, "roles", []) or [])] for p in target_perms)
-        has_write = any("write" in [str(r).lower() for r in (getattr(p, "roles", []) or [])] for p in target_perms)
-
-        desired = (SHARE_PERMISSION or "").lower().strip()
-
-        # 取消分享
-        if desired == "none":
-            if not target_perms:
-                print("无可取消的权限。")
-                return
-            for p in target_perms:
-                if getattr(p, "id", None):
-                    await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).permissions.by_permission_id(p.id).delete()
-            print(f"已取消 {RECIPIENT_EMAIL} 的权限。")
-            return
+    target_perms = [p for p in all_permissions if permission_for_email(p, recipient_email)]
+    has_read = any("read" in [str(r).lower() for r in (getattr(p, "roles", []) or [])] for p in target_perms)
+    has_write = any("write" in [str(r).lower() for r in (getattr(p, "roles", []) or [])] for p in target_perms)
 
-        # 赋予/调整分享
-        if desired in ("read", "write"):
-            # 已满足目标权限则不操作
-            if desired == "write" and has_write:
-                print(f"{RECIPIENT_EMAIL} 已具有写入权限，无需更改。")
-                return
-            if desired == "read" and has_read and not has_write:
-                print(f"{RECIPIENT_EMAIL} 已具有读取权限，无需更改。")
-                return
-
-            # 需要变更：先删除原有权限，再重新邀请
-            for p in target_perms:
-                if getattr(p, "id", None):
-                    await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).permissions.by_permission_id(p.id).delete()
-
-            body = InvitePostRequestBody(
-                recipients=[DriveRecipient(email=RECIPIENT_EMAIL)],
-                require_sign_in=True,
-                send_invitation=False,
-                roles=[desired],
-            )
-            await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).invite.post(body)
-            print(f"已为 {RECIPIENT_EMAIL} 赋予 {desired} 权限。")
-            return
+    desired = (share_permission or "").lower().strip()
+    delete_ids = [p.id for p in target_perms if getattr(p, "id", None)]
 
-        print(f"未知的 SHARE_PERMISSION: {SHARE_PERMISSION}，不执行操作。")
-    except Exception as e:
-        print(f"处理权限时出错: {e}")
-        raise e
+    # 取消分享
+    if desired == "none":
+        if not delete_ids:
+            return [], None, "无可取消的权限。"
+        return delete_ids, None, f"取消 {recipient_email} 的权限。"
+
+    # 赋予/调整分享
+    if desired in ("read", "write"):
+        # 已满足目标权限则不操作
+        if desired == "write" and has_write:
+            return [], None, f"{recipient_email} 已具有写入权限，无需更改。"
+        if desired == "read" and has_read and not has_write:
+            return [], None, f"{recipient_email} 已具有读取权限，无需更改。"
+        # 需要变更：先删除原有权限，再重新邀请
+        return delete_ids, desired, f"为 {recipient_email} 赋予 {desired} 权限。"
+
+    return [], None, f"未知的 SHARE_PERMISSION: {share_permission}，不执行操作。"
 
 
-async def manage_permissions(graph_client: GraphServiceClient, drive_id: str, item_id: str):
+async def apply_item_permissions(graph_client: GraphServiceClient, drive_id: str, item_id: str, delete_ids, invite_role: str, recipient_email: str):
+    """
+    删除指定的权限，再按需邀请 recipient_email 并赋予 invite_role。已不存在的权限直接跳过，重试时不会因此失败
+    """
+    for permission_id in delete_ids:
+        try:
+            await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).permissions.by_permission_id(permission_id).delete()
+        except Exception as e:
+            if get_status_code(e) != 404:
+                raise
+    if invite_role:
+        from msgraph.generated.models.drive_recipient import DriveRecipient
+        from msgraph.generated.drives.item.items.item.invite.invite_post_request_body import InvitePostRequestBody
+        body = InvitePostRequestBody(
+            recipients=[DriveRecipient(email=recipient_email)],
+            require_sign_in=True,
+            send_invitation=False,
+            roles=[invite_role],
+        )
+        await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).invite.post(body)
+
+
+async def manage_permissions(graph_client: GraphServiceClient, drive_id: str, item_id: str, recursive: bool = None, recipient_email: str = None, share_permission: str = None, plan_path: str = None, name: str = None):
     """
     根据配置的 SHARE_PERMISSION 来赋权或取消赋权给指定账号。
+    recursive 为 None 时询问用户是否递归处理子项，recipient_email 与 share_permission 为 None 时使用对应的配置项。
+    plan_path 不为 None 时不修改权限，需要的变更写入该计划文件，由 apply_plan 执行。
+    """
+    if plan_path is None:
+        await process_permissions(graph_client, drive_id, item_id, recursive, recipient_email, share_permission, name=name)
+        return
+    # 中断时遍历不完整，不生成计划
+    with PlanWriter(plan_path, "onedrive_permission_manager", drive_id=drive_id, recipient_email=recipient_email or RECIPIENT_EMAIL) as plan:
+        await process_permissions(graph_client, drive_id, item_id, recursive, recipient_email, share_permission, plan, name)
+        plan.close(discard=interrupt_handler.interrupted)
+    if not interrupt_handler.interrupted:
+        print_message(f"执行计划已写入 {plan_path} ，共 {plan.count} 个项目需要变更权限。", PROGRESS_MODE, name)
+
+
+async def process_permissions(graph_client: GraphServiceClient, drive_id: str, item_id: str, recursive: bool = None, recipient_email: str = None, share_permission: str = None, plan: PlanWriter = None, name: str = None):
+    """
+    处理项目及其子项的权限，plan 不为 None 时只将需要的变更写入计划
     """
     # 先处理传入的 item
     # 处理完当前项后，询问用户是否递归处理子项
-    # 使用list记录待处理的项，将递归操作转为循环操作
     global id2Name
     # 处理当前项
-    await item_permissions_handler(graph_client, drive_id, item_id)
+    await item_permissions_handler(graph_client, drive_id, item_id, recipient_email, share_permission, plan, name)
 
     # 询问是否递归
-    choice = input("是否递归处理子项? (y/N): ").strip().lower()
-    if choice != "y":
+    if recursive is None:
+        recursive = input("是否递归处理子项? (y/N): ").strip().lower() == "y"
+    if not recursive:
         return
 
-    # 使用队列进行迭代遍历
-    queue = [item_id]
-    visited = set()
-
-    while queue:
-        parent_id = queue.pop(0)
-        if not parent_id or parent_id in visited:
+    # 遍历子项，列举在后台并发进行，权限按返回顺序逐个处理
+    root = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).get()
+    def on_list_failed(entry, e):
+        print_message(f"枚举子项失败: {entry.record.name or entry.record.id} - {e}", PROGRESS_MODE, name)
+    async for entry in walk(graph_client, drive_id, ItemRecord.from_drive_item(root), concurrency=CONCURRENCY, on_error=on_list_failed):
+        # 起点本身（为文件时 walk 会返回它）已在上面处理过
+        if entry.depth == 0:
             continue
-        visited.add(parent_id)
-
-        # 获取父项详情（用于判断是否为文件夹）
+        if entry.record.name:
+            id2Name[entry.record.id] = entry.record.name
+        # 处理子项权限，单个子项出错不影响其它子项
         try:
-            parent_item = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(parent_id).get()
-            if parent_item and getattr(parent_item, "id", None) and getattr(parent_item, "name", None):
-                id2Name[parent_item.id] = parent_item.name
-            # 仅文件夹才有 children
-            if not parent_item or not getattr(parent_item, "folder", None):
-                continue
-        except Exception as e:
-            print(f"获取项目详情失败: {e}")
+            await item_permissions_handler(graph_client, drive_id, entry.record.id, recipient_email, share_permission, plan, name)
+        except Exception:
             continue
 
-        # 分页遍历子项
-        try:
-            result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(parent_id).children.get()
-            while True:
-                if result and getattr(result, "value", None):
-                    for child in (result.value or []):
-                        cid = getattr(child, "id", None)
-                        if not cid:
-                            continue
-                        if getattr(child, "name", None):
-                            id2Name[cid] = child.name
-                        # 处理子项权限
-                        await item_permissions_handler(graph_client, drive_id, cid)
-                        # 入队以继续向下遍历
-                        queue.append(cid)
-
-                next_link = getattr(result, "odata_next_link", None) if result else None
-                if not next_link:
-                    break
-                result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(parent_id).children.with_url(next_link).get()
-        except Exception as e:
-            print(f"枚举子项失败: {e}")
-            continue
 
-
-async def get_drive_item_by_path(graph_client: GraphServiceClient, drive_id: str, path: str):
+async def apply_plan(graph_client: GraphServiceClient, path: str, name: str = None):
     """
-    通过路径逐段遍历 children 来获取 DriveItem。
-    返回找到的 DriveItem，否则返回 None。
+    执行 manage_permissions 生成的计划，并发修改各项目的权限，不再遍历与查询权限
     """
-    try:
-        global id2Name
-        normalized = (path or "").strip().strip("/")
-        # 获取根 DriveItem 以拿到 root 的 item_id
-        root_item = await graph_client.drives.by_drive_id(drive_id).root.get()
-        if not root_item or not getattr(root_item, "id", None):
-            return None
-
-        # 空路径表示根
-        if not normalized:
-            return root_item
-
-        current_id = root_item.id
-        if not current_id:
-            return None
-        segments = [seg for seg in normalized.split("/") if seg]
-
-        for seg in segments:
-            found = None
-            # 获取当前节点的所有子项（处理分页）
-            if not current_id:
-                return None
-            result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(current_id).children.get()
-            while True:
-                if result and getattr(result, "value", None):
-                    for child in (result.value or []):
-                        if getattr(child, "name", None) == seg:
-                            found = child
-                            break
-                if found is not None:
-                    break
-                next_link = getattr(result, "odata_next_link", None) if result else None
-                if not next_link:
-                    break
-                result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(current_id).children.with_url(next_link).get()
-
-            if found is None or not getattr(found, "id", None):
-                return None
-            current_id = found.id
-            id2Name[found.id] = found.name
-
-        # 返回最终节点的完整详情
-        if not current_id:
-            return None
-        final_item = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(current_id).get()
-        return final_item
-    except Exception:
-        # 让调用方决定如何提示错误，这里返回 None
-        return None
+    header = read_plan_header(path, "onedrive_permission_manager")
+    drive_id = header["drive_id"]
+    recipient_email = header["recipient_email"]
+    failed = 0
+
+    async def apply_task_func(action):
+        await apply_item_permissions(graph_client, drive_id, action["item_id"], action["delete"], action["invite"], recipient_email)
+        print_message(f"已处理项目：{action['name'] or action['item_id']} 的权限", PROGRESS_MODE, name)
+    def on_apply_failed(action, e):
+        nonlocal failed
+        failed += 1
+        print_message(f"处理项目：{action['name'] or action['item_id']} 的权限时出错: {e}", PROGRESS_MODE, name)
+
+    apply_executor = AsyncTaskExecutor(CONCURRENCY, apply_task_func, retry_policy=RetryPolicy(max_attempts=MAX_ATTEMPTS), on_dead_letter=on_apply_failed)
+    await apply_executor.add_tasks(read_plan_actions(path, "permission"))
+    await apply_executor.shutdown()
+    if failed:
+        raise RuntimeError(f"{failed} 个项目的权限处理失败")
 
 
 async def main():
     """
     主函数，用于认证并启动文件权限管理流程。
     """
+    if RUN_MODE not in RUN_MODES:
+        print(f"未知的 RUN_MODE: {RUN_MODE}，可选 {', '.join(RUN_MODES)}")
+        return
+
+    from fileBackedDeviceCodeCredential import FileBackedDeviceCodeCredential
+
     # 定义权限范围
     scopes = ["https://graph.microsoft.com/.default"]
     
     try:
         credential = FileBackedDeviceCodeCredential(client_id=CLIENT_ID, file_path=CREDENTIAL_FILE_PATH)
-        graph_client = GraphServiceClient(credentials=credential, scopes=scopes)
+        shared_transport.configure(CONCURRENCY)
+        graph_client = shared_transport.create_graph_client(credential, scopes)
 
         # 获取用户信息，从而找到 Drive ID
         drive = await graph_client.me.drive.get()
@@ -269,6 +271,16 @@ async def main():
              print("认证错误: 设备代码认证流程未完成或已超时。")
         return
 
+    if RUN_MODE == "apply":
+        print(f"正在执行计划 {PLAN_PATH} ...")
+        try:
+            await apply_plan(graph_client, PLAN_PATH)
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f"执行计划失败: {e}")
+            return
+        print("\n执行计划完成。")
+        return
+
     try:
         # 根据路径获取文件夹的 DriveItem
         print(f"正在查找文件夹: '{FOLDER_PATH}'")
@@ -277,6 +289,7 @@ async def main():
         if not target_folder or not target_folder.id:
             print(f"找不到指定的文件夹: '{FOLDER_PATH}'")
             return
+        id2Name[target_folder.id] = target_folder.name
         
         print(f"找到文件夹 ID: {target_folder.id}")
         
@@ -285,9 +298,10 @@ async def main():
         print("请检查路径是否正确，以及应用是否具有足够的权限 (例如 Files.ReadWrite.All)。")
         return
 
-    # 处理文件夹权限
-    await manage_permissions(graph_client, drive_id, target_folder.id)
-    print("\n文件夹权限处理完成。")
+    # 处理文件夹权限，plan 模式下只生成执行计划
+    await manage_permissions(graph_client, drive_id, target_folder.id, plan_path=PLAN_PATH if RUN_MODE == "plan" else None)
+    if RUN_MODE == "run":
+        print("\n文件夹权限处理完成。")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+import asyncio
+import json
+import sys
+import time
+
+# 进度统计与渲染器
+class ProgressReporter:
+    """
+    热路径上只做整数累加，由后台协程按固定频率统一渲染，避免每发现一个项目就重建一次界面。
+    mode 为 live 时使用 rich 的 Live 渲染，为 jsonl 时每个周期向 stream 输出一行 JSON，适合定时任务或 CI。
+    counters 为 (键, 显示名, rich 样式) 的列表，total_key 为发现总数对应的键，done_keys 为视为处理完成的键。
+    name 用于在多个任务同时运行时区分输出。
+    """
+    def __init__(self, counters, total_key, done_keys, mode = "live", interval = None, stream = None, name = None):
+        self.name = name
+        self.counters = counters
+        self.counts = {key: 0 for key, _, _ in counters}
+        self.total_key = total_key
+        self.done_keys = tuple(done_keys)
+        self.mode = mode
+        if self.mode not in ("live", "jsonl"):
+            raise ValueError(f"未知的进度输出模式: {mode}")
+        self.interval = interval if interval else (0.25 if self.mode == "live" else 5.0)
+        self.stream = stream if stream is not None else sys.stdout
+        self.discovery_finished = False
+        self.paused = False
+        self.live = None
+        self.render_task = None
+        self.start_time = None
+        # 上一次渲染时的采样，用于计算瞬时速率
+        self.last_sample = None
+        self.discover_rate = 0.0
+        self.process_rate = 0.0
+
+    def incr(self, key, n = 1):
+        self.counts[key] += n
+
+    def finish_discovery(self):
+        """
+        标记发现阶段结束，此后剩余时间的估算不再带有下限标记
+        """
+        self.discovery_finished = True
+
+    @property
+    def done(self):
+        return sum(self.counts[key] for key in self.done_keys)
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.last_sample = (self.start_time, 0, 0)
+        if self.mode == "live":
+            # 只有在需要渲染时才加载 rich
+            from rich.console import Console
+            from rich.live import Live
+            self.live = Live(console=Console(), auto_refresh=False)
+            self.live.start()
+        self.render_task = asyncio.create_task(self._render_loop())
+
+    async def stop(self):
+        if self.render_task:
+            self.render_task.cancel()
+            await asyncio.gather(self.render_task, return_exceptions=True)
+            self.render_task = None
+        self.render(final=True)
+        if self.live:
+            self.live.stop()
+            self.live = None
+
+    def pause(self):
+        """
+        暂停渲染，用于需要在终端中与用户交互的场景
+        """
+        self.paused = True
+        if self.live:
+            self.live.stop()
+
+    def resume(self):
+        self.paused = False
+        if self.live:
+            self.live.start()
+
+    def print(self, message):
+        """
+        输出一条日志，live 模式下打印在进度上方，jsonl 模式下作为 message 事件输出
+        """
+        if self.live:
+            from rich.markup import escape
+            self.live.console.print(f"{escape(f'[{self.name}]')} {message}" if self.name else message)
+        elif self.mode == "jsonl":
+            from rich.text import Text
+            self._emit({"event": "message", "time": time.time(), "message": Text.from_markup(message).plain})
+        else:
+            print(message)
+
+    def snapshot(self):
+        now = time.monotonic()
+        total = self.counts[self.total_key]
+        done = self.done
+        last_time, last_total, last_done = self.last_sample
+        elapsed = now - last_time
+        if elapsed > 0:
+            # 指数平滑，避免速率在刷新间隔之间大幅抖动
+            self.discover_rate = 0.7 * self.discover_rate + 0.3 * (total - last_total) / elapsed
+            self.process_rate = 0.7 * self.process_rate + 0.3 * (done - last_done) / elapsed
+        self.last_sample = (now, total, done)
+        remaining = total - done
+        eta = remaining / self.process_rate if self.process_rate > 0 and remaining > 0 else None
+        return {
+            "elapsed": now - self.start_time,
+            "counts": dict(self.counts),
+            "discover_rate": self.discover_rate,
+            "process_rate": self.process_rate,
+            "eta": eta,
+            "discovery_finished": self.discovery_finished,
+        }
+
+    def render(self, final = False):
+        if self.start_time is None or (self.paused and not final):
+            return
+        snap = self.snapshot()
+        if self.mode == "jsonl":
+            self._emit({"event": "final" if final else "progress", "time": time.time(), **snap})
+        elif self.live:
+            self.live.update(self._format(snap), refresh=True)
+
+    def _format(self, snap):
+        parts = [f"[bold]{self.name}[/]"] if self.name else []
+        parts.extend(f"[{style}]{label}: {snap['counts'][key]}[/]" for key, label, style in self.counters)
+        parts.append(f"[cyan]发现: {snap['discover_rate']:.1f}/s 处理: {snap['process_rate']:.1f}/s[/]")
+        if snap["eta"] is not None:
+            prefix = "" if snap["discovery_finished"] else "≥"
+            parts.append(f"[magenta]剩余: {prefix}{format_duration(snap['eta'])}[/]")
+        parts.append(f"[dim]已用: {format_duration(snap['elapsed'])}[/]")
+        return " ".join(parts)
+
+    def _emit(self, record):
+        if self.name:
+            record = {"job": self.name, **record}
+        self.stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.stream.flush()
+
+    async def _render_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.render()
+
+
+def escape_markup(value):
+    """
+    转义插入到 rich 标记中的文件名、错误信息等，其中的方括号不会被当作标记解析
+    """
+    from rich.markup import escape
+    return escape(str(value))
+
+
+def print_message(message, mode = "live", name = None, stream = None):
+    """
+    在进度显示之外输出一条纯文本日志，jsonl 模式下与 ProgressReporter.print 一样作为 message 事件输出，保证输出流中每行都是 JSON
+    """
+    if mode != "jsonl":
+        print(message)
+        return
+    record = {"event": "message", "time": time.time(), "message": message}
+    if name:
+        record = {"job": name, **record}
+    stream = stream if stream is not None else sys.stdout
+    stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+    stream.flush()
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
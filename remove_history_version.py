@@ -4,15 +4,23 @@
 # 1. Files.ReadWrite.All: 允许应用读取、创建、修改和删除所有用户的 OneDrive 文件。这是分享和遍历文件夹所必需的。
 # 2. User.Read: 允许应用读取登录用户的基本个人资料。
 
+from __future__ import annotations
+
 import asyncio
-import aiohttp
-from rich.live import Live
-from rich.console import Console
+from typing import TYPE_CHECKING
 from urllib import parse
-from asyncTaskExecutor import AsyncTaskExecutor
-from fileBackedDeviceCodeCredential import FileBackedDeviceCodeCredential
-from msgraph.generated.models.drive_item import DriveItem
-from msgraph.graph_service_client import GraphServiceClient
+from asyncTaskExecutor import AsyncTaskExecutor, RetryPolicy, read_dead_letters, write_dead_letter, interrupt_handler
+from driveItemRecord import ItemRecord, SpillList
+from progressReporter import ProgressReporter, escape_markup, print_message
+from driveWalker import get_drive_item_by_path, walk
+from executionPlan import PlanWriter, RUN_MODES, read_plan_actions, read_plan_header
+from httpTransport import shared_transport
+
+# msgraph、azure.identity 与 httpx 导入耗时较长，只在用到时导入，脚本启动与被其它脚本导入时无需等待
+if TYPE_CHECKING:
+    import httpx
+    from msgraph.generated.models.drive_item import DriveItem
+    from msgraph.graph_service_client import GraphServiceClient
 
 # --- 配置信息 ---
 # 在 Azure AD 中注册应用后获取，形如aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee
@@ -23,14 +31,80 @@ ITEM_PATH = "/新建文件夹"
 CREDENTIAL_FILE_PATH = "userXXX.json"
 # 同时处理的任务数
 CONCURRENCY = 5
+# 文件列表在内存中保留的最大条目数，超出部分溢出到临时文件，为 None 时不溢出
+SPILL_THRESHOLD = 100000
+# 单个任务的最大尝试次数，遇到限流、服务端错误或网络错误时按指数退避重试
+MAX_ATTEMPTS = 5
+# 单个任务单次尝试的超时时间（秒），超时后按重试策略重试，为 None 时不限制
+TASK_TIMEOUT = 300
+# 重试后仍失败的文件会以 JSON 行追加到此文件
+DEAD_LETTER_PATH = "remove_history_version_failed.jsonl"
+# 设置为死信文件路径时，跳过交互直接重新处理其中的文件
+REPLAY_DEAD_LETTER_PATH = None
+# 执行模式，run 为遍历后直接移除，plan 为只遍历并将每个文件待移除的版本写入 PLAN_PATH，apply 为跳过交互直接执行 PLAN_PATH 中的计划
+RUN_MODE = "run"
+# 执行计划文件路径
+PLAN_PATH = "remove_history_version_plan.jsonl"
+# 进度输出方式，live 为终端实时刷新，jsonl 为每隔一段时间输出一行 JSON（适合定时任务或 CI）
+PROGRESS_MODE = "live"
+# 进度刷新间隔（秒），为 None 时 live 模式 0.25 秒，jsonl 模式 5 秒
+PROGRESS_INTERVAL = None
 
 # 全局变量
-refresh_event = asyncio.Event()
-refersh_lock = asyncio.Lock()
 headers = {
     # 此处的Headers需要从浏览器请求中获取，先打开F12的网络面板，然后在OneDrive网页端删除某个文件的历史版本，搜索RecycleByLabel，选中请求，复制为Fetch(Node.js),然后取出其中的Headers
 }
 
+
+# SharePoint REST 请求返回 403，请求令牌可能已过期
+class RequestDigestExpired(Exception):
+    def __init__(self, digest):
+        super().__init__("请求令牌可能已过期")
+        # 发出请求时使用的令牌，用于判断是否已被其它任务刷新
+        self.digest = digest
+
+
+# 网页逆向请求使用的请求头
+class SharePointSession:
+    """
+    保存从浏览器复制的请求头。请求令牌（x-requestdigest）过期时由第一个发现的任务提示输入新令牌，其余任务等待刷新完成后重试。
+    刷新在任务的超时计时之外进行，等待输入不会使任务超时；无论刷新是否完成，结束后都会恢复其它任务与进度显示。
+    interactive 为 False 时（批量执行）不提示输入，令牌过期后标记为 expired，之后的文件不再发出请求，直接失败并写入死信文件。
+    """
+    def __init__(self, headers, interactive = True):
+        self.headers = headers
+        self.interactive = interactive
+        self.expired = False
+        self.lock = asyncio.Lock()
+        self.ready = asyncio.Event()
+        self.ready.set()
+
+    @property
+    def digest(self):
+        return self.headers.get("x-requestdigest", "")
+
+    async def refresh(self, stale_digest, progress: ProgressReporter):
+        async with self.lock:
+            if self.digest != stale_digest:
+                # 已被其它任务刷新
+                return
+            if not self.interactive:
+                self.expired = True
+                raise RuntimeError("请求令牌已过期，请更新请求头后重新处理死信文件")
+            self.ready.clear()
+            progress.pause()
+            try:
+                new_requestdigest = ""
+                while not new_requestdigest:
+                    new_requestdigest = await asyncio.get_running_loop().run_in_executor(None, input, "请求令牌可能已过期，请输入新的请求令牌（x-requestdigest）并回车以继续: ")
+                    new_requestdigest = new_requestdigest.strip()
+                self.headers["x-requestdigest"] = new_requestdigest
+            finally:
+                self.ready.set()
+                progress.resume()
+
+default_session = SharePointSession(headers)
+
 def full_quote(s):
     s_quoted = parse.quote(s, safe='')
     
@@ -48,13 +122,12 @@ def full_quote(s):
     return s_quoted
 
 
-async def remove_file_versions(session: aiohttp.ClientSession, item: DriveItem, versionLabel: str, live: Live):
+async def remove_file_versions(http_client: httpx.AsyncClient, session: SharePointSession, item: ItemRecord, versionLabel: str, progress: ProgressReporter):
     """
-    使用网页逆向出来的请求移除项目的历史版本
+    使用网页逆向出来的请求移除项目的历史版本，返回 403 时抛出 RequestDigestExpired，由执行器在刷新令牌后重试
     """
-    global headers
     if not item or not getattr(item, "id", None):
-        print("无效的 DriveItem，无法处理。")
+        progress.print("无效的 DriveItem，无法处理。")
         return
     web_url = getattr(item, "web_url")
     prefix = '/'.join(web_url.split('/')[:5])
@@ -62,190 +135,256 @@ async def remove_file_versions(session: aiohttp.ClientSession, item: DriveItem,
     new_web_url = full_quote(f"'{new_web_url}'")
     versionLabel = full_quote(f"'{versionLabel}'")
     url = f"{prefix}/_api/web/GetFileByServerRelativePath(decodedUrl=@a1)/versions/RecycleByLabel(versionLabel=@a2)?@a1={new_web_url}&@a2={versionLabel}"
-    await refresh_event.wait()
     # 保留旧的，以便验证是否已被刷新，避免重复刷新
-    old_requestdigest = headers.get("x-requestdigest", "")
-    async with session.post(url, headers=headers) as resp:
-        text = await resp.text()
-        if '\\u' in text:
-            # 尝试解码 Unicode 转义字符
-            text = text.encode('utf-8').decode('unicode_escape')
-        if resp.status != 200:
-            if resp.status == 403:
-                # 令牌过期，触发刷新token，目前只处理403错误
-                async with refersh_lock:
-                    if old_requestdigest == headers.get("x-requestdigest", ""):
-                        refresh_event.clear()
-                        new_requestdigest = None
-                        live.stop()
-                        while not new_requestdigest:
-                            new_requestdigest = await asyncio.get_event_loop().run_in_executor(None, input, "请求令牌可能已过期，请输入新的请求令牌（x-requestdigest）并回车以继续: ")
-                            new_requestdigest = new_requestdigest.strip()
-                            if new_requestdigest:
-                                headers["x-requestdigest"] = new_requestdigest
-                                refresh_event.set()
-                        # 令牌刷新完成，重试请求
-                        live.start()
-                    await remove_file_versions(session, item, versionLabel, live)
-            else:
-                print(f"移除版本 {versionLabel} 失败: HTTP {resp.status} - {text}，项目name{item.name} id:{item.id} web_url:{item.web_url}")
-        elif text != '{"d":{"RecycleByLabel":null}}':
-            print(f"警告: URL {url} 非预期响应内容: {text}，项目name{item.name} id:{item.id} web_url:{item.web_url}")
-
-async def traverse_and_remove_versions(graph_client: GraphServiceClient, item: DriveItem):
+    old_requestdigest = session.digest
+    resp = await http_client.post(url, headers=session.headers)
+    text = resp.text
+    if '\\u' in text:
+        # 尝试解码 Unicode 转义字符
+        text = text.encode('utf-8').decode('unicode_escape')
+    if resp.status_code != 200:
+        if resp.status_code == 403:
+            # 令牌过期，目前只处理403错误
+            raise RequestDigestExpired(old_requestdigest)
+        import httpx
+        raise httpx.HTTPStatusError(f"移除版本 {versionLabel} 失败: {text}", request=resp.request, response=resp)
+    elif text != '{"d":{"RecycleByLabel":null}}':
+        progress.print(escape_markup(f"警告: URL {url} 非预期响应内容: {text}，项目name{item.name} id:{item.id} web_url:{item.web_url}"))
+
+def create_progress(name: str = None, planning: bool = False):
+    """
+    创建进度器，统计 总数，无历史，已移除，失败的数量，planning 为 True 时以 已计划 代替 已移除
+    """
+    return ProgressReporter(
+        [("total", "总数", "bold blue"), ("no_history", "无历史", "bold yellow"), ("removed", "已计划" if planning else "已移除", "bold green"), ("failed", "失败", "bold red")],
+        total_key="total",
+        done_keys=("no_history", "removed", "failed"),
+        mode=PROGRESS_MODE,
+        interval=PROGRESS_INTERVAL,
+        name=name,
+    )
+
+async def list_old_version_labels(graph_client: GraphServiceClient, drive_id: str, item: ItemRecord):
     """
-    递归遍历项目及其子项，移除所有历史版本。
+    获取文件除最新版本外的所有版本号，从新到旧排列
+    """
+    versions = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item.id).versions.get()
+    if not versions or not getattr(versions, "value", None):
+        return []
+    versionLabels = [float(getattr(ver, "id")) for ver in (versions.value or []) if getattr(ver, "id", None)]
+    # 将版本号从大到小排序，只保留最新版本
+    versionLabels.sort(reverse=True)
+    return [str(vlabel) for vlabel in versionLabels[1:]]
+
+
+async def traverse_and_remove_versions(graph_client: GraphServiceClient, item: DriveItem, dead_letter_path: str = None, name: str = None, plan_path: str = None, session: SharePointSession = None):
+    """
+    递归遍历项目及其子项，移除所有历史版本。dead_letter_path 为 None 时使用配置项，name 用于区分同时运行的多个任务的输出。
+    plan_path 不为 None 时只查询各文件的历史版本而不移除，待移除的版本写入该计划文件，由 apply_plan 执行。
+    session 为移除请求使用的请求头，为 None 时使用 default_session。
     """
     if not item or not getattr(item, "id", None):
-        print("无效的 DriveItem，无法处理。")
+        print_message("无效的 DriveItem，无法处理。", PROGRESS_MODE, name)
         return
     
     drive_id = getattr(item.parent_reference, "drive_id")
     
-    total_count = 0
-    removed_count = 0
-    no_history_count = 0
-    failed_count = 0
-
-    # 使用 rich 库打印信息
-    live = Live(console=Console())
-    def print_status():
-        live.update(f"[bold blue]总数: {total_count}[/] [bold yellow]无历史: {no_history_count}[/] [bold green]已移除: {removed_count}[/] [bold red]失败: {failed_count}[/]")
-
-    # 遍历项目及其子项，获取所有的文件
-    traverse_executor = AsyncTaskExecutor(CONCURRENCY)
-    files = []
-    async def traverse_task_func(task):
-        nonlocal total_count
-        item = task
-        # 如果是文件，添加到列表
-        if getattr(item, "file", None):
-            files.append(item)
-            total_count += 1
-            print_status()
-        # 如果是文件夹，获取其子项
-        if getattr(item, "folder", None):
-            result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item.id).children.get()
-            while True:
-                if result and getattr(result, "value", None):
-                    for child in (result.value or []):
-                        # 文件，添加到文件列表
-                        if getattr(child, "file", None):
-                            files.append(child)
-                            total_count += 1
-                            print_status()
-                        # 文件夹，添加到任务队列继续遍历
-                        if getattr(child, "folder", None):
-                            await traverse_executor.add_task(child)
-                next_link = getattr(result, "odata_next_link", None) if result else None
-                if not next_link:
-                    break
-                result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item.id).children.with_url(next_link).get()
-    
-    traverse_executor.task_func = traverse_task_func
-    live.start()
-    await traverse_executor.add_task(item)
-    await traverse_executor.join()
-    await traverse_executor.shutdown()
-    
-    # 检查并移除文件的历史版本
-    async with aiohttp.ClientSession() as session:
-        async def remove_task_func(task):
-            nonlocal removed_count, no_history_count, failed_count
-            item = task
-            versions = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item.id).versions.get()
-            if not versions or not getattr(versions, "value", None):
-                no_history_count += 1
-                print_status()
-                return
-            versionLabels = [float(getattr(ver, "id")) for ver in (versions.value or []) if getattr(ver, "id", None)]
-            # 将版本号从大到小排序，只保留最新版本
-            versionLabels.sort(reverse=True)
-            if len(versionLabels) <= 1:
-                no_history_count += 1
-                print_status()
-                return
+    progress = create_progress(name, planning=plan_path is not None)
+    progress.start()
+    # plan 模式下遍历失败的文件夹不写入死信文件，计划中不包含其下的文件，需重新生成计划
+    files = await collect_files(graph_client, drive_id, ItemRecord.from_drive_item(item), progress, (dead_letter_path or DEAD_LETTER_PATH) if plan_path is None else None)
+    progress.finish_discovery()
+
+    if plan_path is None:
+        # 检查并移除文件的历史版本
+        await run_remove_tasks(graph_client, drive_id, files, progress, dead_letter_path, session)
+    else:
+        # 只查询历史版本，写入计划；中断时查询不完整，不生成计划
+        with PlanWriter(plan_path, "remove_history_version", drive_id=drive_id) as plan:
+            await run_plan_tasks(graph_client, drive_id, files, progress, plan, dead_letter_path)
+            plan.close(discard=interrupt_handler.interrupted)
+    files.close()
+    await progress.stop()
+    if plan_path is not None and not interrupt_handler.interrupted:
+        print_message(f"执行计划已写入 {plan_path} ，共 {plan.count} 个文件需要移除历史版本。", PROGRESS_MODE, name)
+        if progress.counts["failed"]:
+            print_message(f"{progress.counts['failed']} 个文件夹遍历失败或文件查询失败，计划中不包含其下的文件。", PROGRESS_MODE, name)
+
+
+async def collect_files(graph_client: GraphServiceClient, drive_id: str, root: ItemRecord, progress: ProgressReporter, dead_letter_path: str = None):
+    """
+    遍历 root 及其子项，返回所有文件的精简记录列表。
+    遍历失败的文件夹计为失败，dead_letter_path 不为 None 时以 walk 任务写入死信文件，重新处理时重新遍历该文件夹。
+    中断时尚未遍历的文件夹同样以 walk 任务写入死信文件。
+    """
+    def on_traverse_failed(entry, e):
+        progress.print(f"[bold red]遍历文件夹 {escape_markup(entry.record.name or entry.record.id)} 失败，其下的文件未处理: {escape_markup(e)}[/]")
+        progress.incr("total")
+        progress.incr("failed")
+        if dead_letter_path:
+            write_dead_letter(dead_letter_path, {"type": "walk", "drive_id": drive_id, "item": entry.record}, f"{type(e).__name__}: {e}")
+    def on_traverse_cancelled(entry):
+        if dead_letter_path:
+            write_dead_letter(dead_letter_path, {"type": "walk", "drive_id": drive_id, "item": entry.record}, "cancelled", 0)
+    files = SpillList(SPILL_THRESHOLD, decode=lambda row: ItemRecord(*row))
+    async for entry in walk(
+        graph_client,
+        drive_id,
+        root,
+        concurrency=CONCURRENCY,
+        item_filter=lambda entry: not entry.record.is_folder,
+        retry_policy=RetryPolicy(max_attempts=MAX_ATTEMPTS),
+        task_timeout=TASK_TIMEOUT,
+        on_error=on_traverse_failed,
+        on_cancelled=on_traverse_cancelled,
+    ):
+        files.append(entry.record)
+        progress.incr("total")
+    return files
+
+
+def create_remove_executor(drive_id: str, task_func, progress: ProgressReporter, dead_letter_path: str = None, action: str = "移除", get_item = lambda task: task, session: SharePointSession = None):
+    """
+    创建处理文件的执行器，失败的文件按重试策略重试，仍失败的写入死信文件，可通过 REPLAY_DEAD_LETTER_PATH 重新处理。
+    get_item 用于从任务中取出文件记录，死信中只记录文件本身。
+    每次尝试前等待令牌刷新完成，TASK_TIMEOUT 只限制单次尝试；请求令牌过期时在计时之外刷新后重新尝试。
+    session 为 None 时使用以 headers 创建的 default_session。
+    """
+    session = session or default_session
+    def on_remove_failed(task, e):
+        item = get_item(task)
+        progress.print(f"{action}文件 {escape_markup(item.name or '未知')} 的历史版本时发生错误: {escape_markup(e)}")
+        progress.incr("failed")
+    async def run_with_refresh(task):
+        while True:
+            await session.ready.wait()
+            if session.expired:
+                raise RuntimeError("请求令牌已过期，未发出请求")
             try:
-                for vlabel in versionLabels[1:]:
-                    await remove_file_versions(session, item, str(vlabel), live)
-                removed_count += 1
-                print_status()
-            except Exception as e:
-                print(f"移除文件 {getattr(item, 'name', '未知')} 的历史版本时发生错误: {e}")
-                failed_count += 1
-                print_status()
-                return
-        refresh_event.set()
-        remove_executor = AsyncTaskExecutor(CONCURRENCY, remove_task_func)
-        await remove_executor.add_tasks(files)
-        await remove_executor.shutdown()
-    live.stop()
+                return await asyncio.wait_for(task_func(task), TASK_TIMEOUT)
+            except RequestDigestExpired as e:
+                await session.refresh(e.digest, progress)
+    return AsyncTaskExecutor(
+        CONCURRENCY,
+        run_with_refresh,
+        retry_policy=RetryPolicy(max_attempts=MAX_ATTEMPTS),
+        dead_letter_path=dead_letter_path or DEAD_LETTER_PATH,
+        task_encoder=lambda task: {"drive_id": drive_id, "item": get_item(task)},
+        on_dead_letter=on_remove_failed,
+    )
 
 
-async def get_drive_item_by_path(graph_client: GraphServiceClient, drive_id: str, path: str):
+async def run_remove_tasks(graph_client: GraphServiceClient, drive_id: str, files, progress: ProgressReporter, dead_letter_path: str = None, session: SharePointSession = None):
     """
-    通过路径逐段遍历 children 来获取 DriveItem。
-    返回找到的 DriveItem，否则返回 None。
+    检查并移除文件的历史版本
     """
-    try:
-        normalized = (path or "").strip().strip("/")
-        # 获取根 DriveItem 以拿到 root 的 item_id
-        root_item = await graph_client.drives.by_drive_id(drive_id).root.get()
-        if not root_item or not getattr(root_item, "id", None):
-            return None
-
-        # 空路径表示根
-        if not normalized:
-            return root_item
-
-        current_id = root_item.id
-        if not current_id:
-            return None
-        segments = [seg for seg in normalized.split("/") if seg]
-
-        for seg in segments:
-            found = None
-            # 获取当前节点的所有子项（处理分页）
-            if not current_id:
-                return None
-            result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(current_id).children.get()
-            while True:
-                if result and getattr(result, "value", None):
-                    for child in (result.value or []):
-                        if getattr(child, "name", None) == seg:
-                            found = child
-                            break
-                if found is not None:
-                    break
-                next_link = getattr(result, "odata_next_link", None) if result else None
-                if not next_link:
-                    break
-                result = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(current_id).children.with_url(next_link).get()
-
-            if found is None or not getattr(found, "id", None):
-                return None
-            current_id = found.id
-
-        # 返回最终节点的完整详情
-        if not current_id:
-            return None
-        final_item = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(current_id).get()
-        return final_item
-    except Exception:
-        # 让调用方决定如何提示错误，这里返回 None
-        return None
+    session = session or default_session
+    http_client = shared_transport.rest_client()
+    async def remove_task_func(task):
+        item = task
+        versionLabels = await list_old_version_labels(graph_client, drive_id, item)
+        if not versionLabels:
+            progress.incr("no_history")
+            return
+        for vlabel in versionLabels:
+            await remove_file_versions(http_client, session, item, vlabel, progress)
+        progress.incr("removed")
+    remove_executor = create_remove_executor(drive_id, remove_task_func, progress, dead_letter_path, session=session)
+    await remove_executor.add_tasks(files)
+    await remove_executor.shutdown()
+
+
+async def run_plan_tasks(graph_client: GraphServiceClient, drive_id: str, files, progress: ProgressReporter, plan: PlanWriter, dead_letter_path: str = None):
+    """
+    查询文件的历史版本，有历史版本的文件连同待移除的版本号写入计划
+    """
+    async def plan_task_func(task):
+        item = task
+        versionLabels = await list_old_version_labels(graph_client, drive_id, item)
+        if not versionLabels:
+            progress.incr("no_history")
+            return
+        plan.add("recycle_versions", item=item, versions=versionLabels)
+        progress.incr("removed")
+    plan_executor = create_remove_executor(drive_id, plan_task_func, progress, dead_letter_path, action="查询")
+    await plan_executor.add_tasks(files)
+    await plan_executor.shutdown()
+
+
+async def apply_plan(graph_client: GraphServiceClient, path: str, dead_letter_path: str = None, name: str = None, session: SharePointSession = None):
+    """
+    执行 traverse_and_remove_versions 生成的计划，直接按计划中的版本号移除，不再遍历与查询版本。
+    失败的文件与直接运行时一样写入死信文件，重新处理时会重新查询其版本。
+    """
+    drive_id = read_plan_header(path, "remove_history_version")["drive_id"]
+    progress = create_progress(name)
+    progress.start()
+    progress.incr("total", sum(1 for _ in read_plan_actions(path, "recycle_versions")))
+    progress.finish_discovery()
+
+    session = session or default_session
+    http_client = shared_transport.rest_client()
+    async def recycle_task_func(task):
+        item, versionLabels = task
+        # 已移除的版本从任务中去掉，重试时只处理剩余的版本，已不存在的版本不会使重试失败
+        while versionLabels:
+            await remove_file_versions(http_client, session, item, versionLabels[0], progress)
+            versionLabels.pop(0)
+        progress.incr("removed")
+    recycle_executor = create_remove_executor(drive_id, recycle_task_func, progress, dead_letter_path, get_item=lambda task: task[0], session=session)
+    await recycle_executor.add_tasks((ItemRecord(*action["item"]), action["versions"]) for action in read_plan_actions(path, "recycle_versions"))
+    await recycle_executor.shutdown()
+    await progress.stop()
+
+
+async def replay_dead_letters(graph_client: GraphServiceClient, path: str, dead_letter_path: str = None, name: str = None, session: SharePointSession = None):
+    """
+    重新处理死信文件中记录的文件，walk 任务对应遍历失败或未遍历的文件夹，重新遍历后处理其下的文件
+    """
+    dead_letter_path = dead_letter_path or DEAD_LETTER_PATH
+    files = dict()
+    walks = []
+    for task in read_dead_letters(path):
+        if task.get("type") == "walk":
+            walks.append(task)
+        else:
+            files.setdefault(task["drive_id"], []).append(ItemRecord(*task["item"]))
+    # 死信文件与本次输出为同一文件时，清空后再记录本次的失败
+    if path == dead_letter_path:
+        open(path, "w", encoding="utf-8").close()
+
+    progress = create_progress(name)
+    progress.start()
+    progress.incr("total", sum(len(group) for group in files.values()))
+    walked = []
+    for task in walks:
+        walked.append((task["drive_id"], await collect_files(graph_client, task["drive_id"], ItemRecord(*task["item"]), progress, dead_letter_path)))
+    progress.finish_discovery()
+    for drive_id, group in list(files.items()) + walked:
+        await run_remove_tasks(graph_client, drive_id, group, progress, dead_letter_path, session)
+    for _, group in walked:
+        group.close()
+    await progress.stop()
 
 
 async def main():
     """
     主函数
     """
+    if RUN_MODE not in RUN_MODES:
+        print(f"未知的 RUN_MODE: {RUN_MODE}，可选 {', '.join(RUN_MODES)}")
+        return
+
+    from fileBackedDeviceCodeCredential import FileBackedDeviceCodeCredential
+
     # 定义权限范围
     scopes = ["https://graph.microsoft.com/.default"]
     
     try:
         credential = FileBackedDeviceCodeCredential(client_id=CLIENT_ID, file_path=CREDENTIAL_FILE_PATH)
-        graph_client = GraphServiceClient(credentials=credential, scopes=scopes)
+        # Graph 请求与 SharePoint REST 请求共用同一个连接池
+        shared_transport.configure(CONCURRENCY)
+        graph_client = shared_transport.create_graph_client(credential, scopes)
 
         # 获取用户信息，从而找到 Drive ID
         drive = await graph_client.me.drive.get()
@@ -264,6 +403,31 @@ async def main():
              print("认证错误: 设备代码认证流程未完成或已超时。")
         return
 
+    if REPLAY_DEAD_LETTER_PATH:
+        print(f"正在重新处理 {REPLAY_DEAD_LETTER_PATH} 中失败的文件 ...")
+        interrupt_handler.install()
+        try:
+            await replay_dead_letters(graph_client, REPLAY_DEAD_LETTER_PATH)
+        finally:
+            interrupt_handler.uninstall()
+        report_interrupted()
+        return
+
+    if RUN_MODE == "apply":
+        print(f"正在执行计划 {PLAN_PATH} ...")
+        interrupt_handler.install()
+        try:
+            await apply_plan(graph_client, PLAN_PATH)
+        except (OSError, ValueError) as e:
+            print(f"读取执行计划失败: {e}")
+            return
+        finally:
+            interrupt_handler.uninstall()
+        if report_interrupted():
+            return
+        print("执行计划完成。")
+        return
+
     global ITEM_PATH
     tmp_path = input(f"请输入要操作的文件或文件夹路径（默认: {ITEM_PATH}）: ")
     if tmp_path:
@@ -282,10 +446,25 @@ async def main():
         print(f"查找路径时发生错误: {e}")
         return
     
-    # 移除目标项及其子项的所有历史版本
-    await traverse_and_remove_versions(graph_client, target_item)
+    # 移除目标项及其子项的所有历史版本，plan 模式下只生成执行计划，第一次 Ctrl-C 停止处理新的文件，等待执行中的请求完成，第二次强制中止
+    interrupt_handler.install()
+    try:
+        await traverse_and_remove_versions(graph_client, target_item, plan_path=PLAN_PATH if RUN_MODE == "plan" else None)
+    finally:
+        interrupt_handler.uninstall()
+    if report_interrupted() or RUN_MODE == "plan":
+        return
     print("指定项目及其子项的历史版本移除完成。")
 
+def report_interrupted():
+    if interrupt_handler.interrupted and RUN_MODE == "plan":
+        print("任务已中断，查询不完整，未生成执行计划。")
+        return True
+    if interrupt_handler.interrupted:
+        print(f"任务已中断，未处理的文件与尚未遍历的文件夹已写入 {DEAD_LETTER_PATH} ，将 REPLAY_DEAD_LETTER_PATH 设置为该文件可继续处理。")
+        return True
+    return False
+
 if __name__ == "__main__":
     # 提示用户进行设备代码认证
     print("该脚本需要您进行认证。")
@@ -0,0 +1,161 @@
+# 流式复制：服务端无法复制的文件（跨租户、部分共享项等）从源的下载地址分块下载，再写入目标的上传会话
+# 数据只在内存中经过，不写临时文件。分块并行下载，上传会话要求分块按顺序上传，
+# 单个文件同时在内存中的分块不超过 PREFETCH_CHUNKS + 1 个，即内存占用不超过 CHUNK_SIZE * (PREFETCH_CHUNKS + 1)
+
+import asyncio
+from collections import deque
+from urllib import parse
+from asyncTaskExecutor import RetryPolicy, call_with_retry
+from driveItemRecord import ItemRecord
+from httpTransport import GRAPH_BASE_URL, raise_for_status, shared_transport
+
+# 分块大小（字节），上传会话要求为 320 KiB 的整数倍，且单次不超过 60 MiB
+CHUNK_SIZE = 320 * 1024 * 32
+# 每个文件预先下载的分块数，下载与上传同时进行
+PREFETCH_CHUNKS = 4
+# 单个分块的最大尝试次数，遇到限流、服务端错误或网络错误时按指数退避重试
+CHUNK_MAX_ATTEMPTS = 5
+# 单个分块单次尝试的超时时间（秒）
+CHUNK_TIMEOUT = 120
+
+
+async def get_download_url(graph_client, drive_id: str, item_id: str):
+    """
+    获取源文件的预授权下载地址，地址有效期较短，过期后需重新获取
+    """
+    item = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(item_id).get()
+    url = (getattr(item, "additional_data", None) or {}).get("@microsoft.graph.downloadUrl", None)
+    if not url:
+        raise RuntimeError("无法获取源文件的下载地址")
+    return url
+
+
+# 源文件的下载地址
+class DownloadSource:
+    """
+    按字节范围读取源文件。下载地址自带授权，过期（401/403）时由第一个发现的分块重新获取，其余分块复用新地址。
+    """
+    def __init__(self, graph_client, drive_id: str, item_id: str):
+        self.graph_client = graph_client
+        self.drive_id = drive_id
+        self.item_id = item_id
+        self.url = None
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, stale_url):
+        async with self._lock:
+            if self.url == stale_url:
+                self.url = await get_download_url(self.graph_client, self.drive_id, self.item_id)
+        return self.url
+
+    async def read(self, http_client, start: int, end: int):
+        """
+        读取 [start, end) 范围内的字节
+        """
+        url = self.url or await self.refresh(None)
+        headers = {"Range": f"bytes={start}-{end - 1}"}
+        response = await http_client.get(url, headers=headers, follow_redirects=True)
+        if response.status_code in (401, 403):
+            url = await self.refresh(url)
+            response = await http_client.get(url, headers=headers, follow_redirects=True)
+        raise_for_status(response, "下载分块")
+        data = response.content
+        if len(data) != end - start:
+            raise RuntimeError(f"下载的分块长度 {len(data)} 与请求的范围 {start}-{end - 1} 不符")
+        return data
+
+
+async def create_upload_session(graph_client, drive_id: str, parent_id: str, name: str, conflict_behavior: str):
+    """
+    在目标父文件夹下为文件创建上传会话，返回上传地址
+    """
+    from msgraph.generated.drives.item.items.item.create_upload_session.create_upload_session_post_request_body import CreateUploadSessionPostRequestBody
+    from msgraph.generated.models.drive_item_uploadable_properties import DriveItemUploadableProperties
+    body = CreateUploadSessionPostRequestBody(
+        item=DriveItemUploadableProperties(additional_data={"@microsoft.graph.conflictBehavior": conflict_behavior}),
+    )
+    # 以路径寻址的 id（parent:/name:）会被 SDK 整体编码，这里直接拼出地址
+    url = f"{GRAPH_BASE_URL}/drives/{drive_id}/items/{parent_id}:/{parse.quote(name)}:/createUploadSession"
+    upload_session = await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(parent_id).create_upload_session.with_url(url).post(body)
+    if not upload_session or not upload_session.upload_url:
+        raise RuntimeError("创建上传会话失败")
+    return upload_session.upload_url
+
+
+async def upload_chunk(http_client, upload_url: str, start: int, data: bytes, size: int):
+    """
+    上传一个分块。重试时服务端可能已接收过该分块（响应 416），此时按会话状态中的下一个期望位置判断是否已完成
+    """
+    end = start + len(data)
+    response = await http_client.put(upload_url, content=data, headers={"Content-Range": f"bytes {start}-{end - 1}/{size}"})
+    if response.status_code == 416:
+        status = await http_client.get(upload_url)
+        if status.status_code == 200:
+            ranges = status.json().get("nextExpectedRanges", None) or []
+            if ranges and int(ranges[0].split("-")[0]) >= end:
+                return None
+    raise_for_status(response, "上传分块")
+    # 最后一个分块上传完成后返回新建的文件
+    return response.json() if response.status_code in (200, 201) else None
+
+
+async def create_empty_file(graph_client, drive_id: str, parent_id: str, name: str, conflict_behavior: str):
+    """
+    上传会话不接受空内容，空文件直接创建
+    """
+    from msgraph.generated.models.drive_item import DriveItem
+    from msgraph.generated.models.file import File
+    body = DriveItem(name=name, file=File(), additional_data={"@microsoft.graph.conflictBehavior": conflict_behavior})
+    return await graph_client.drives.by_drive_id(drive_id).items.by_drive_item_id(parent_id).children.post(body)
+
+
+async def stream_copy_file(graph_client, source_drive_id: str, item: ItemRecord, target_drive_id: str, target_parent_id: str, conflict_behavior: str):
+    """
+    将源文件流式复制到目标父文件夹下。每个分块按重试策略单独重试，
+    分块重试后仍失败时放弃上传会话并抛出异常，由调用方的任务执行器决定是否整体重试。
+    """
+    size = item.size
+    if size is None:
+        source_item = await graph_client.drives.by_drive_id(source_drive_id).items.by_drive_item_id(item.id).get()
+        size = source_item.size or 0
+    if size == 0:
+        await create_empty_file(graph_client, target_drive_id, target_parent_id, item.name, conflict_behavior)
+        return
+
+    http_client = shared_transport.rest_client()
+    retry_policy = RetryPolicy(max_attempts=CHUNK_MAX_ATTEMPTS)
+    source = DownloadSource(graph_client, source_drive_id, item.id)
+    # 先创建上传会话，目标不可写或已存在同名文件时不必下载
+    upload_url = await create_upload_session(graph_client, target_drive_id, target_parent_id, item.name, conflict_behavior)
+
+    offsets = iter(range(0, size, CHUNK_SIZE))
+    pending = deque()
+    def prefetch():
+        start = next(offsets, None)
+        if start is not None:
+            end = min(start + CHUNK_SIZE, size)
+            pending.append((start, asyncio.create_task(call_with_retry(source.read, http_client, start, end, retry_policy=retry_policy, timeout=CHUNK_TIMEOUT))))
+
+    try:
+        for _ in range(PREFETCH_CHUNKS):
+            prefetch()
+        uploaded = None
+        while pending:
+            start, download = pending.popleft()
+            data = await download
+            prefetch()
+            uploaded = await call_with_retry(upload_chunk, http_client, upload_url, start, data, size, retry_policy=retry_policy, timeout=CHUNK_TIMEOUT)
+            del data
+        if not uploaded or uploaded.get("size", size) != size:
+            raise RuntimeError(f"上传完成后目标文件大小 {uploaded.get('size') if uploaded else None} 与源文件 {size} 不符")
+    except Exception:
+        # 放弃上传会话，释放服务端已接收的分块
+        try:
+            await http_client.delete(upload_url)
+        except Exception:
+            pass
+        raise
+    finally:
+        for _, download in pending:
+            download.cancel()
+        await asyncio.gather(*(download for _, download in pending), return_exceptions=True)